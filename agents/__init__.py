@@ -1,4 +1,10 @@
 from .base_agent import BaseAgent
+from .policy_player import PolicyPlayer
 # from .policy_search import PolicySearch_Agent
-from .ddpg_agent import DeepDPGAgent
-from .ddpg_agent import DeepDPGPlayer
+try:
+    from .ddpg_agent import DeepDPGAgent
+    from .ddpg_agent import DeepDPGPlayer
+except ImportError as e:
+    # Without TensorFlow only trained policies can be played, with PolicyPlayer
+    if e.name != 'tensorflow':
+        raise
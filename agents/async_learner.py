@@ -0,0 +1,86 @@
+import threading
+import time
+
+
+class AsyncLearner:
+    """Trains an agent on a background thread, continuously sampling its replay buffer.
+
+    Acting uses the actor snapshot, which the learner refreshes every `snapshot_every` updates, so the
+    acting thread never waits for a training step; the snapshot lock of the actor keeps it from reading a
+    half-copied snapshot. With `max_updates_per_step` the learner pauses when it is that many updates per
+    environment step ahead.
+
+    An exception stops the learner, check() raises it again in the thread driving the agent.
+
+    Counters:
+        updates: training updates run so far
+        staleness: updates run since the snapshot used for acting was taken
+        updates_per_second: training rate, measured over the last second or more
+    """
+    def __init__(self, agent, snapshot_every=10, max_updates_per_step=None):
+        self.agent = agent
+        self.snapshot_every = snapshot_every
+        self.max_updates_per_step = max_updates_per_step
+
+        self.updates = 0
+        self.snapshot_updates = 0
+        self.snapshot_time = time.perf_counter()
+        self.updates_per_second = 0.0
+        self.error = None
+        self._rate_updates = 0
+        self._rate_time = self.snapshot_time
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def staleness(self):
+        return self.updates - self.snapshot_updates
+
+    @property
+    def snapshot_age(self):
+        """Seconds since the snapshot used for acting was taken."""
+        return time.perf_counter() - self.snapshot_time
+
+    def _ready(self):
+        agent = self.agent
+        if len(agent.replay_buffer) < agent.schedule.warmup:
+            return False
+        if self.max_updates_per_step is not None:
+            return self.updates < self.max_updates_per_step * agent.env_steps
+        return True
+
+    def check(self):
+        """Raise the exception which stopped the learner, if any."""
+        if self.error is not None:
+            raise RuntimeError("The learner thread failed") from self.error
+
+    def _run(self):
+        try:
+            self._learn()
+        except Exception as e:
+            self.error = e
+
+    def _learn(self):
+        while not self._stop.is_set():
+            if not self._ready():
+                time.sleep(0.001)
+                continue
+
+            self.agent.learn()
+            self.updates += 1
+            if self.updates - self.snapshot_updates >= self.snapshot_every:
+                self.agent.actor.update_snapshot()
+                self.snapshot_updates = self.updates
+                self.snapshot_time = time.perf_counter()
+
+            now = time.perf_counter()
+            if now - self._rate_time >= 1.0:
+                self.updates_per_second = (self.updates - self._rate_updates) / (now - self._rate_time)
+                self._rate_updates = self.updates
+                self._rate_time = now
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,180 @@
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .numpy_actor import NumpyActor
+
+
+def _write_atomic(path, write):
+    tmp_path = str(path) + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, str(path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointManager:
+    """Checkpoints an agent at the end of episodes, writing the files on a background thread.
+
+    At the end of an episode, episode_done() copies the variables out of the session when a checkpoint is due:
+    every `every_episodes` episodes, at most once per `every_seconds` seconds when given, and whenever the
+    score ranks among the `keep_best` best. The score is an evaluation score when given to episode_done() or
+    returned by `evaluate`, a function of the agent which must return the score of an episode played without
+    exploration noise (helpers.play_episode() itself returns nothing), otherwise the training score of the
+    episode. The copies are written to `directory` on a writer thread, each file replaced atomically, while
+    training goes on; at most `max_pending` checkpoints wait for the writer. Saving also flushes the replay
+    buffer of the agent, like DeepDPGAgent.save().
+
+    A checkpoint which cannot be written for lack of disk space or permissions is reported and skipped. Any
+    other error of the writer is raised again by the next episode_done(), save() or flush().
+
+    Each checkpoint has an .npz file of the variables and the policy file of the target actor, see
+    NumpyActor.save(). The latest checkpoint and the best ones by score are kept, <name>.checkpoints.json lists
+    them; PolicyPlayer plays <task>.latest.policy.npz in models/. With `policy_only` only the policy files are
+    written, which restore() cannot load.
+    """
+    def __init__(self, directory='models', name=None, every_episodes=1, every_seconds=None, keep_best=3,
+                 policy_only=False, max_pending=2, evaluate=None):
+        self.directory = Path(directory)
+        self.name = name
+        self.every_episodes = every_episodes
+        self.every_seconds = every_seconds
+        self.keep_best = keep_best
+        self.policy_only = policy_only
+        self.evaluate = evaluate
+        self.error = None
+
+        self.agent = None
+        self.episodes = 0
+        self.saved_episode = 0
+        self.saved_time = time.perf_counter()
+        # (score, episode) of the best checkpoints, best first
+        self.best = []
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_agent(self, agent):
+        self.agent = agent
+        self.name = self.name or agent.task.task_name
+        self.directory.mkdir(exist_ok=True)
+        index = self.path('checkpoints.json')
+        if index.exists():
+            with open(str(index)) as f:
+                index = json.load(f)
+            self.best = [tuple(entry) for entry in index['best']]
+            self.episodes = self.saved_episode = index['latest']
+
+    def path(self, suffix):
+        return self.directory / '{}.{}'.format(self.name, suffix)
+
+    def _files(self, label):
+        return self.path(label + '.policy.npz'), self.path(label + '.ckpt.npz')
+
+    def episode_done(self, score, eval_score=None):
+        """Count an episode ending with `score`, snapshot the agent when a checkpoint is due.
+
+        The checkpoints are ranked by `eval_score`, or the score of `evaluate` if any, otherwise by `score`.
+        """
+        self.check()
+        self.episodes += 1
+        if eval_score is None and self.evaluate is not None:
+            eval_score = self.evaluate(self.agent)
+            if eval_score is None:
+                raise ValueError("CheckpointManager evaluate() returned no score")
+        # A plain float, NumPy scalars are not JSON serializable
+        score = float(score if eval_score is None else eval_score)
+        best = self.keep_best > 0 and (len(self.best) < self.keep_best or score > self.best[-1][0])
+        due = self.episodes - self.saved_episode >= self.every_episodes and (
+            self.every_seconds is None or time.perf_counter() - self.saved_time >= self.every_seconds)
+        if best or due:
+            self.save(score, best)
+
+    def save(self, score=None, best=False):
+        """Snapshot the variables now and queue their checkpoint, ranked by `score` with `best`."""
+        self.check()
+        agent = self.agent
+        target = agent.actor.network_variables['target']
+        if self.policy_only:
+            values, weights = None, agent.session.run(target)
+        else:
+            values, weights = agent.session.run([agent.checkpoint_variables, target])
+            values = {v.name: value for v, value in zip(agent.checkpoint_variables, values)}
+        policy = NumpyActor(weights, agent.task.action_low, agent.task.action_high)
+        agent.replay_buffer.flush()
+
+        evicted = []
+        if best:
+            self.best.append((float(score), self.episodes))
+            self.best.sort(key=lambda entry: -entry[0])
+            evicted = [episode for _, episode in self.best[self.keep_best:]]
+            self.best = self.best[:self.keep_best]
+        self.saved_episode = self.episodes
+        self.saved_time = time.perf_counter()
+        self._queue.put((self.episodes, values, policy, best, list(self.best), evicted))
+
+    def _write(self, episode, values, policy, best, best_list, evicted):
+        labels = ['latest'] + (['ep{:06d}'.format(episode)] if best else [])
+        for label in labels:
+            policy_file, ckpt_file = self._files(label)
+            policy.save(str(policy_file))
+            if values is not None:
+                _write_atomic(ckpt_file, lambda f: np.savez(f, **values))
+
+        index = {'latest': episode, 'best': best_list}
+        _write_atomic(self.path('checkpoints.json'), lambda f: f.write(json.dumps(index).encode()))
+        for episode in evicted:
+            for path in self._files('ep{:06d}'.format(episode)):
+                if path.exists():
+                    path.unlink()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._write(*job)
+            except OSError as e:
+                print("Checkpoint could not be written: {}".format(e))
+            except Exception as e:
+                # Keep taking jobs, so that save() never blocks on a full queue
+                self.error = self.error or e
+            finally:
+                self._queue.task_done()
+
+    def check(self):
+        """Raise the exception which stopped a checkpoint from being written, if any."""
+        if self.error is not None:
+            raise RuntimeError("The checkpoint writer failed") from self.error
+
+    def flush(self):
+        """Wait for the queued checkpoints to be written."""
+        self._queue.join()
+        self.check()
+
+    def restore(self, label='latest'):
+        """Load the variables of a checkpoint into the agent, returns False without one."""
+        path = self.path(label + '.ckpt.npz')
+        if self.policy_only or not path.exists():
+            return False
+        agent = self.agent
+        with np.load(str(path)) as values:
+            for v in agent.checkpoint_variables:
+                v.load(values[v.name], agent.session)
+        agent.actor.update_snapshot()
+        agent.refresh_numpy_actors()
+        return True
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -1,3 +1,5 @@
+import threading
+
 import numpy as np
 import tensorflow as tf
 
@@ -6,11 +8,18 @@ from .utils import scope_variables_mapping
 
 class Actor:
     def __init__(self, task, critic, scope_name='actor', learning_rate=0.001):
+        self.scope = scope_name
         self.input = tf.placeholder(tf.float32, (None, task.num_states), name='actor/states')
         self.is_training = tf.placeholder(tf.bool, name='actor/is_training')
 
         self.target = self.create_model(self.input, task, scope_name + '_target')
         self.current = self.create_model(self.input, task, scope_name + '_current', self.is_training)
+        # Copy of the current network for acting while a learner thread trains, not saved
+        self.snapshot = self.create_model(self.input, task, scope_name + '_snapshot', trainable=False)
+        self.snapshot_variables = tf.global_variables(scope_name + '_snapshot')
+        # Kernels and biases of the dense layers in order, see weights()
+        self.network_variables = {name: tf.global_variables(scope_name + '_' + name)
+                                  for name in ('current', 'target', 'snapshot')}
 
         self.q_gradients = tf.placeholder(tf.float32, (None, task.num_actions))
 
@@ -19,8 +28,8 @@ class Actor:
         tf.losses.add_loss(loss)
 
         with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-            optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
-            self.optimizer = optimizer.minimize(loss, var_list=tf.trainable_variables(scope_name + '_current'))
+            self.adam = tf.train.AdamOptimizer(learning_rate=learning_rate)
+            self.optimizer = self.adam.minimize(loss, var_list=tf.trainable_variables(scope_name + '_current'))
 
         self.tau = tf.placeholder(tf.float32)
         self.assignments = [tf.assign(t, c * self.tau + (1-self.tau) * t)
@@ -29,16 +38,24 @@ class Actor:
         self.init = [tf.assign(t, c)
                      for c, t in scope_variables_mapping(scope_name + '_current', scope_name + '_target')]
 
+        self.snapshot_update = [tf.assign(s, c) for c, s in scope_variables_mapping(
+            scope_name + '_current', scope_name + '_snapshot', tf.GraphKeys.GLOBAL_VARIABLES)]
+        # The assignments of a snapshot update run in any order, actions wait for all of them
+        self.snapshot_lock = threading.Lock()
+
         self.session = None
 
     def initialize(self):
         self.session.run(self.init)
+        self.update_snapshot()
 
-    def create_model(self, inputs, task, scope_name, training=False):
+    def create_model(self, inputs, task, scope_name, training=False, reuse=False, trainable=True):
         g = 0.001
         eps = 1
-        with tf.variable_scope(scope_name):
+        # Resource variables are read where they are used, inside control dependencies and graph loops
+        with tf.variable_scope(scope_name, reuse=reuse, use_resource=True):
             dense = tf.layers.dense(inputs, 64,
+                                    trainable=trainable,
                                     activation=tf.nn.relu,
                                     kernel_initializer=tf.contrib.layers.xavier_initializer())
             # dense = tf.layers.dropout(dense, 0.5, training=training)
@@ -46,6 +63,7 @@ class Actor:
             # dense = tf.layers.batch_normalization(dense, training=training)
 
             dense = tf.layers.dense(dense, 128,
+                                    trainable=trainable,
                                     activation=tf.nn.relu,
                                     kernel_initializer=tf.contrib.layers.xavier_initializer())
             # dense = tf.layers.dropout(dense, 0.5, training=training)
@@ -53,6 +71,7 @@ class Actor:
             # dense = tf.layers.batch_normalization(dense, training=training)
 
             dense = tf.layers.dense(dense, 128,
+                                    trainable=trainable,
                                     activation=tf.nn.relu,
                                     kernel_initializer=tf.contrib.layers.xavier_initializer())
             # dense = tf.layers.dropout(dense, 0.5, training=training)
@@ -60,6 +79,7 @@ class Actor:
             # dense = tf.layers.batch_normalization(dense, training=training)
 
             dense = tf.layers.dense(dense, task.num_actions,
+                                    trainable=trainable,
                                     activation=tf.nn.tanh,
                                     kernel_initializer=tf.random_uniform_initializer(minval=-g, maxval=g),
                                     bias_initializer=tf.random_uniform_initializer(minval=-g, maxval=g))
@@ -83,6 +103,18 @@ class Actor:
                 self.input: state,
                 self.is_training: False})
 
+    def get_snapshot_action(self, state):
+        with self.snapshot_lock:
+            return self.session.run(self.snapshot, feed_dict={self.input: state})
+
+    def update_snapshot(self):
+        with self.snapshot_lock:
+            self.session.run(self.snapshot_update)
+
+    def weights(self, network='current'):
+        """Values of the kernels and biases of the 'current', 'target' or 'snapshot' network, see NumpyActor."""
+        return self.session.run(self.network_variables[network])
+
     def get_target_action(self, state):
         return self.session.run(
             self.target,
@@ -5,11 +5,23 @@ import tensorflow as tf
 from .base_agent import BaseAgent
 
 from .replay_buffer import ReplayBuffer
+from .prefetcher import BatchPrefetcher
+from .async_learner import AsyncLearner
 from .ddpg_actor import Actor
+from .numpy_actor import NumpyActor
+from .policy_player import PolicyPlayer, policy_path
 from .ddpg_critic import Critic
+from .ddpg_train_step import TrainStep
+from .training_schedule import TrainingSchedule
 from .noise import OUNoise, OUNoise2
 
 
+def saved_variables(actor):
+    """All variables but the actor snapshot, which is a copy of the current actor."""
+    snapshot = set(v.name for v in actor.snapshot_variables)
+    return [v for v in tf.global_variables() if v.name not in snapshot]
+
+
 class DeepDPGAgent(BaseAgent):
     batch_size = 64
     tau = 0.01
@@ -23,18 +35,38 @@ class DeepDPGAgent(BaseAgent):
     https://arxiv.org/pdf/1509.02971.pdf
 
     """
-    def __init__(self, task, replay_buffer_size=None, batch_size=None):
+    def __init__(self, task, replay_buffer_size=None, batch_size=None, replay_buffer=None, n_step=1,
+                 prefetch=0, schedule=None, async_learning=False, snapshot_every=10, max_updates_per_step=None,
+                 numpy_every=0, checkpoints=None):
         """Initialize policy and other agent parameters.
 
         Should be able to access the following (OpenAI Gym spaces):
             task.observation_space  # i.e. state space
             task.action_space
+
+        `replay_buffer` replaces the default uniform ReplayBuffer, e.g. with a PrioritizedReplayBuffer.
+        With `n_step` > 1 the critic targets are n-step returns, which the replay buffer must link. With
+        `prefetch` > 0 that many batches are sampled ahead on a background thread. `schedule` is a
+        TrainingSchedule, by default one update per environment step.
+
+        With `async_learning` an AsyncLearner thread trains continuously and the agent acts on the actor
+        snapshot, refreshed every `snapshot_every` updates; the schedule then only sets the warmup. With
+        `max_updates_per_step` the learner runs at most that many updates per environment step. An exception
+        of the learner is raised again by the next train() or step().
+        With `numpy_every` > 0 acting evaluates NumPy copies of the actor networks instead, refreshed every
+        `numpy_every` updates.
+
+        `checkpoints` is a CheckpointManager which replaces the checkpoint saved after every episode in
+        models/ and restores the latest one at start.
         """
         super().__init__(task)
+        if n_step > 1 and replay_buffer is not None and not replay_buffer.linked:
+            raise ValueError("{} does not support n-step returns".format(type(replay_buffer).__name__))
 
         # Create actor and critic
         self.critic = Critic(task, learning_rate=DeepDPGAgent.learning_rate * 10)
         self.actor = Actor(task, self.critic, learning_rate = DeepDPGAgent.learning_rate)
+        self.train_step = TrainStep(task, self.actor, self.critic, tau=DeepDPGAgent.tau)
 
         self.noise = OUNoise2(
         #self.noise = OUNoise(
@@ -44,13 +76,18 @@ class DeepDPGAgent(BaseAgent):
 
         # Create critic NN
         self.replay_buffer_size = replay_buffer_size if replay_buffer_size is not None else DeepDPGAgent.replay_buffer_size
-        self.replay_buffer = ReplayBuffer(self.replay_buffer_size)
+        if replay_buffer is not None:
+            self.replay_buffer = replay_buffer
+            self.replay_buffer_size = replay_buffer.max_size
+        else:
+            self.replay_buffer = ReplayBuffer(self.replay_buffer_size)
 
         self.session = tf.Session()
         self.session.run(tf.global_variables_initializer())
 
         self.actor.set_session(self.session)
         self.critic.set_session(self.session)
+        self.train_step.set_session(self.session)
 
         self.actor.initialize()
         self.critic.initialize()
@@ -62,6 +99,12 @@ class DeepDPGAgent(BaseAgent):
         self.batch_size = batch_size or DeepDPGAgent.batch_size
         self.tau = DeepDPGAgent.tau
         self.gamma = DeepDPGAgent.gamma
+        self.n_step = n_step
+        self.schedule = schedule or TrainingSchedule()
+        self.schedule.warmup = max(self.schedule.warmup, self.batch_size)
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = BatchPrefetcher(self.replay_buffer, self.batch_size, prefetch, n_step, self.gamma)
 
         self.best_score = None
         self.episode_score = 0.0
@@ -69,9 +112,28 @@ class DeepDPGAgent(BaseAgent):
 
         self.episode = 1
 
-        self.saver = tf.train.Saver()
-
-        self.load_task_agent()
+        self.checkpoint_variables = saved_variables(self.actor)
+        self.saver = tf.train.Saver(var_list=self.checkpoint_variables)
+
+        self.updates = 0
+        self.numpy_every = numpy_every
+        self.numpy_actor = self.numpy_target = None
+        if numpy_every > 0:
+            self.numpy_actor = NumpyActor(self.actor.weights('current'), task.action_low, task.action_high)
+            self.numpy_target = NumpyActor(self.actor.weights('target'), task.action_low, task.action_high)
+            self.numpy_updates = 0
+
+        self.checkpoints = checkpoints
+        if checkpoints is not None:
+            checkpoints.set_agent(self)
+            checkpoints.restore()
+        else:
+            self.load_task_agent()
+
+        self.env_steps = 0
+        self.learner = None
+        if async_learning:
+            self.learner = AsyncLearner(self, snapshot_every, max_updates_per_step)
 
     def reset_episode(self):
         self.episode_score = 0.0
@@ -79,8 +141,16 @@ class DeepDPGAgent(BaseAgent):
         self.noise.reset()
         return self.task.reset()
 
+    def policy(self, states):
+        """Actions of the actor network: its NumPy copy if any, else its snapshot when learning asynchronously."""
+        if self.numpy_actor is not None:
+            return self.numpy_actor(states)
+        if self.learner is not None:
+            return self.actor.get_snapshot_action(states)
+        return self.actor.get_action(states)
+
     def act(self, state):
-        action = self.actor.get_action(np.expand_dims(state, axis=0))[0]
+        action = self.policy(np.expand_dims(state, axis=0))[0]
 
         action += self.noise.sample()
         action_min = np.empty(self.task.num_actions)
@@ -91,7 +161,16 @@ class DeepDPGAgent(BaseAgent):
 
         return action
 
+    def act_batch(self, states, noise=None):
+        """Actions for a (N, num_states) batch of states, with optional (N, num_actions) exploration noise."""
+        actions = self.policy(states)
+        if noise is not None:
+            actions += noise
+        return np.clip(actions, self.task.action_low, self.task.action_high)
+
     def act_target(self, state):
+        if self.numpy_target is not None:
+            return self.numpy_target(state).copy()
         action = self.actor.get_target_action(np.expand_dims(state, axis=0))[0]
         return action
 
@@ -102,21 +181,7 @@ class DeepDPGAgent(BaseAgent):
         if self.prev_state is not None:
             self.replay_buffer.add([self.prev_state, action, reward, next_state, done])
 
-        if len(self.replay_buffer) >= self.batch_size:
-            batch = self.replay_buffer.sample(self.batch_size)
-
-            prev_states = np.array([t[0] for t in batch])
-            prev_actions = np.array([t[1] for t in batch])
-            rewards = np.expand_dims(np.array([t[2] for t in batch]), axis=1)
-            states = np.array([t[3] for t in batch])
-            dones = np.expand_dims(np.array([t[4] for t in batch], dtype=np.float32), axis=1)
-
-            y = rewards + self.gamma * self.critic.get_target_value(states, self.actor.get_target_action(states)) * (1-dones)
-            self.critic.learn(prev_states, prev_actions, y)
-            self.actor.learn(prev_states)
-
-            self.critic.update_target(self.tau)
-            self.actor.update_target(self.tau)
+        self.train(1, done)
 
         if done:
             if self.best_score is not None:
@@ -124,10 +189,84 @@ class DeepDPGAgent(BaseAgent):
             else:
                 self.best_score = self.episode_score
             self.episode += 1
-            self.save_task_agent()
+            if self.checkpoints is not None:
+                self.checkpoints.episode_done(self.episode_score)
+            else:
+                self.save_task_agent()
 
         self.prev_state = next_state if not done else None
 
+    def train(self, num_steps=1, episode_done=False):
+        """Count `num_steps` environment steps and run the updates the schedule asks for, returns their number."""
+        self.env_steps += num_steps
+        if self.learner is not None:
+            self.learner.check()
+            return 0
+        num_updates = self.schedule.updates_due(num_steps, len(self.replay_buffer), episode_done)
+        if num_updates > 1 and self.schedule.fused and self.prefetcher is None:
+            self.learn_fused(num_updates)
+        else:
+            for _ in range(num_updates):
+                self.learn()
+        return num_updates
+
+    def sample(self, size):
+        """Minibatch from the replay buffer, split into the 5 columns, the discounts and any extra columns."""
+        if self.n_step > 1:
+            batch = self.replay_buffer.sample_n_step(size, self.n_step, self.gamma)
+            return batch[:5], batch[5], batch[6:]
+        batch = self.replay_buffer.sample(size)
+        return batch[:5], self.gamma, batch[5:]
+
+    def learn(self):
+        """Run one training step on a minibatch from the replay buffer."""
+        if self.prefetcher is not None:
+            batch = self.prefetcher.get()
+            if self.n_step > 1:
+                columns, discounts, extra = batch[:5], batch[5], batch[6:]
+            else:
+                columns, discounts, extra = batch[:5], self.gamma, batch[5:]
+        else:
+            columns, discounts, extra = self.sample(self.batch_size)
+        prev_states, prev_actions, rewards, states, dones = columns
+
+        # Target values, both gradient steps and the target updates in one session call
+        if self.replay_buffer.prioritized:
+            weights, indices = extra
+            td_errors = self.train_step.run(prev_states, prev_actions, rewards, states, dones, discounts, weights)
+            self.replay_buffer.update_priorities(indices, td_errors)
+        else:
+            self.train_step.run(prev_states, prev_actions, rewards, states, dones, discounts)
+        self.count_updates(1)
+
+    def learn_fused(self, num_updates):
+        """Run `num_updates` training steps in one graph loop, on minibatches sampled in one call."""
+        columns, discounts, extra = self.sample(num_updates * self.batch_size)
+        if np.ndim(discounts) == 0:
+            discounts = np.full_like(columns[2], discounts)
+        split = [np.reshape(x, (num_updates, self.batch_size) + np.shape(x)[1:]) for x in columns + (discounts,)]
+
+        if self.replay_buffer.prioritized:
+            weights, indices = extra
+            td_errors = self.train_step.run_loop(*split, weights.reshape(num_updates, self.batch_size, 1))
+            self.replay_buffer.update_priorities(indices, td_errors.ravel())
+        else:
+            self.train_step.run_loop(*split)
+        self.count_updates(num_updates)
+
+    def count_updates(self, num_updates):
+        self.updates += num_updates
+        if self.numpy_actor is not None and self.updates - self.numpy_updates >= self.numpy_every:
+            self.refresh_numpy_actors()
+
+    def refresh_numpy_actors(self):
+        """Copy the weights of the actor networks into the NumPy actors."""
+        if self.numpy_actor is None:
+            return
+        self.numpy_actor.set_weights(self.actor.weights('current'))
+        self.numpy_target.set_weights(self.actor.weights('target'))
+        self.numpy_updates = self.updates
+
     def show_episode_stats(self):
         print("Deep DPG episode stats: t = {:4d}, score = {:7.3f} (best = {:7.3f}), noise_scale = {}".format(
             self.episode_ticks, self.episode_score, self.best_score, 0))# self.noise_scale))  # [debug]
@@ -138,13 +277,28 @@ class DeepDPGAgent(BaseAgent):
 
     def load(self, path):
         self.saver.restore(self.session, path)
+        self.actor.update_snapshot()
+        self.refresh_numpy_actors()
         print("Agent has been loaded from " + path)
 
     def save(self, path):
         self.saver.save(self.session, path)
-
-
-class DeepDPGPlayer(BaseAgent):
+        NumpyActor(self.actor.weights('target'), self.task.action_low, self.task.action_high).save(
+            policy_path(path))
+        self.replay_buffer.flush()
+
+    def close(self):
+        """Stop the learner and prefetcher threads, then wait for the checkpoints being written."""
+        if self.learner is not None:
+            self.learner.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+
+
+class DeepDPGPlayer(PolicyPlayer):
+    """Plays the policy of the task's TensorFlow checkpoint, with the critic available for inspection."""
     def __init__(self, task):
         """Initialize policy and other agent parameters.
 
@@ -152,8 +306,6 @@ class DeepDPGPlayer(BaseAgent):
             task.observation_space  # i.e. state space
             task.action_space
         """
-        super().__init__(task)
-
         # Create actor and critic
         self.critic = Critic(task, learning_rate = DeepDPGAgent.learning_rate * 10)
         self.actor = Actor(task, self.critic, learning_rate = DeepDPGAgent.learning_rate)
@@ -167,77 +319,15 @@ class DeepDPGPlayer(BaseAgent):
         self.actor.initialize()
         self.critic.initialize()
 
-        self.best_score = None
-        self.episode_score = 0.0
-        self.episode_ticks = 0
-        self.reset_episode_vars()
-        self.prev_state = None
-
-        self.episode = 1
-
-        self.saver = tf.train.Saver()
-
-        self.num_actions = task.num_actions
-        self.num_states = task.num_states
-
-        self.load_task_agent()
-
-    def reset_episode_vars(self):
-        self.episode_score = 0.0
-        self.episode_ticks = 0
-
-    def act(self, state):
-        return self.actor.get_target_action(np.expand_dims(state, axis=0))[0]
-
-    def step(self, action, reward, next_state, done):
-        """Process state, reward, done flag, and return an action.
-
-        Params
-        ======
-        - state: current state vector as NumPy array, compatible with task's state space
-        - reward: last reward received
-        - done: whether this episode is complete
-
-        Returns
-        =======
-        - action: desired action vector as NumPy array, compatible with task's action space
-        """
-        self.episode_ticks += 1
-        self.episode_score += reward
-
-        action_str = ', '.join('{:7.3f}'.format(a) for a in action)
-        position_str = ', '.join('{:7.3f}'.format(a) for a in self.prev_state[0:6])
-
-        print('[{}] => [{}], R = {:7.3f}'.format(position_str, action_str, reward))
-
-        self.prev_state = next_state
-
-        # Output some information at the end of the episode
-        if done:
-            if self.best_score is not None:
-                self.best_score = max(self.best_score, self.episode_score)
-            else:
-                self.best_score = self.episode_score
-            print("Deep DPG episode stats: t = {:4d}, score = {:7.3f} (best = {:7.3f}), noise_scale = {}".format(
-                self.episode_ticks, self.episode_score, self.best_score, 0))# self.noise_scale))  # [debug]
-            self.reset_episode_vars()
-            self.episode += 1
-
-        return action
+        self.saver = tf.train.Saver(var_list=saved_variables(self.actor))
 
-    def reset_episode(self):
-        self.episode_score = 0.0
-        self.episode_ticks = 0
-        self.prev_state = self.task.reset()
-        return self.prev_state
-
-    @property
-    def noise_scale(self):
-        return 0
+        super().__init__(task)
 
     def load(self, path):
         self.saver.restore(self.session, path)
+        self.policy = NumpyActor(self.actor.weights('target'), self.task.action_low, self.task.action_high)
 
-    def save(self, path):
-        # Can't save anything
-        pass
+    def load_task_agent(self):
+        # Plays the initial weights without a checkpoint
+        self.policy = NumpyActor(self.actor.weights('target'), self.task.action_low, self.task.action_high)
+        BaseAgent.load_task_agent(self)
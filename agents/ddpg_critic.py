@@ -27,7 +27,8 @@ class Critic:
         self.loss = tf.losses.mean_squared_error(self.y, self.current)
         self.learning_rate = learning_rate
         with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-            self.optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate).minimize(self.loss)
+            self.adam = tf.train.AdamOptimizer(learning_rate=learning_rate)
+            self.optimizer = self.adam.minimize(self.loss)
 
         self.tau = tf.placeholder(tf.float32, name='critic/tau')
         self.assignments = [tf.assign(t, c * self.tau + (1-self.tau) * t)
@@ -43,7 +44,8 @@ class Critic:
 
     def create_model(self, input_states, input_actions, task, scope_name, training=False, reuse=False):
 
-        with tf.variable_scope(scope_name, reuse=reuse):
+        # Resource variables are read where they are used, inside control dependencies and graph loops
+        with tf.variable_scope(scope_name, reuse=reuse, use_resource=True):
             g = 0.0001
             # 2 layers of states
             dense_s = tf.layers.dense(input_states, 64,
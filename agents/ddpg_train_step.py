@@ -0,0 +1,131 @@
+import tensorflow as tf
+
+from .utils import scope_variables_mapping
+
+
+class TrainStep:
+    """Whole DDPG update on a minibatch as one graph op, run with a single session.run().
+
+    Builds the TD target from the target networks, applies the critic and actor gradients with the Adam
+    optimizers of `critic` and `actor` (sharing their slots with Critic.learn() and Actor.learn()) and does
+    both Polyak updates, in the order of those calls: the actor gradient is computed with the critic after its
+    step, the target networks are updated from the weights after both steps.
+
+    run_loop() runs K such updates on K minibatches inside one tf.while_loop.
+    """
+    def __init__(self, task, actor, critic, tau=0.01):
+        self.task = task
+        self.actor = actor
+        self.critic = critic
+
+        self.states = tf.placeholder(tf.float32, (None, task.num_states), name='train/states')
+        self.actions = tf.placeholder(tf.float32, (None, task.num_actions), name='train/actions')
+        self.rewards = tf.placeholder(tf.float32, (None, 1), name='train/rewards')
+        self.next_states = tf.placeholder(tf.float32, (None, task.num_states), name='train/next_states')
+        self.dones = tf.placeholder(tf.float32, (None, 1), name='train/dones')
+        # gamma, or gamma^n per sample for n-step returns
+        self.discounts = tf.placeholder(tf.float32, None, name='train/discounts')
+        self.weights = tf.placeholder_with_default(1.0, None, name='train/weights')
+        self.tau = tf.placeholder_with_default(tau, (), name='train/tau')
+
+        self.op, self.td_errors = self.create_update(
+            self.states, self.actions, self.rewards, self.next_states, self.dones, self.discounts, self.weights)
+
+        # The same inputs with a leading axis of K minibatches
+        self.loop_states = tf.placeholder(tf.float32, (None, None, task.num_states), name='train_loop/states')
+        self.loop_actions = tf.placeholder(tf.float32, (None, None, task.num_actions), name='train_loop/actions')
+        self.loop_rewards = tf.placeholder(tf.float32, (None, None, 1), name='train_loop/rewards')
+        self.loop_next_states = tf.placeholder(tf.float32, (None, None, task.num_states),
+                                               name='train_loop/next_states')
+        self.loop_dones = tf.placeholder(tf.float32, (None, None, 1), name='train_loop/dones')
+        self.loop_discounts = tf.placeholder(tf.float32, (None, None, 1), name='train_loop/discounts')
+        self.loop_weights = tf.placeholder_with_default(tf.ones_like(self.loop_rewards), (None, None, 1),
+                                                        name='train_loop/weights')
+
+        num_updates = tf.shape(self.loop_states)[0]
+
+        def body(i, td_errors):
+            # Every read of the weights waits for the updates of the previous iteration
+            with tf.control_dependencies([i]):
+                op, errors = self.create_update(
+                    self.loop_states[i], self.loop_actions[i], self.loop_rewards[i], self.loop_next_states[i],
+                    self.loop_dones[i], self.loop_discounts[i], self.loop_weights[i])
+            with tf.control_dependencies([op]):
+                return i + 1, td_errors.write(i, errors)
+
+        _, td_errors = tf.while_loop(
+            lambda i, _: i < num_updates, body, (tf.constant(0), tf.TensorArray(tf.float32, size=num_updates)),
+            parallel_iterations=1)
+        self.loop_td_errors = td_errors.stack()
+
+        self.session = None
+
+    def create_update(self, states, actions, rewards, next_states, dones, discounts, weights):
+        """Build one update on the given tensors, returns the update op and the TD errors before it."""
+        task, actor, critic = self.task, self.actor, self.critic
+
+        # TD target from the target networks
+        target_actions = actor.create_model(next_states, task, actor.scope + '_target', reuse=True)
+        target_values = critic.create_model(next_states, target_actions, task, critic.scope + '_target',
+                                            reuse=True)
+        y = tf.stop_gradient(rewards + discounts * target_values * (1 - dones))
+
+        values = critic.create_model(states, actions, task, critic.scope + '_current', reuse=True)
+        td_errors = (y - values)[:, 0]
+        critic_loss = tf.losses.mean_squared_error(y, values, weights=weights, loss_collection=None)
+        critic_gradients = critic.adam.compute_gradients(
+            critic_loss, var_list=tf.trainable_variables(critic.scope + '_current'))
+
+        # The critic changes only after its gradient and the target values are computed
+        gradients = [g for g, _ in critic_gradients if g is not None]
+        with tf.control_dependencies(gradients + [y] + tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            critic_step = critic.adam.apply_gradients(critic_gradients)
+
+        # The actor loss reads the critic weights after its step
+        with tf.control_dependencies([critic_step]):
+            policy_actions = actor.create_model(states, task, actor.scope + '_current', reuse=True)
+            actor_loss = tf.reduce_mean(-critic.create_model(states, policy_actions, task,
+                                                             critic.scope + '_current', reuse=True))
+        actor_gradients = actor.adam.compute_gradients(
+            actor_loss, var_list=tf.trainable_variables(actor.scope + '_current'))
+        actor_step = actor.adam.apply_gradients(actor_gradients)
+
+        # read_value() reads the weights inside the control dependencies, after the optimizer steps
+        with tf.control_dependencies([critic_step, actor_step]):
+            assignments = [tf.assign(t, c.read_value() * self.tau + (1 - self.tau) * t.read_value())
+                           for scope in (critic.scope, actor.scope)
+                           for c, t in scope_variables_mapping(scope + '_current', scope + '_target')]
+        return tf.group(*assignments), td_errors
+
+    def set_session(self, session):
+        self.session = session
+
+    def run(self, states, actions, rewards, next_states, dones, discounts, weights=None):
+        """Run one update, returns the TD errors of the batch before it."""
+        feed_dict = {
+            self.states: states,
+            self.actions: actions,
+            self.rewards: rewards,
+            self.next_states: next_states,
+            self.dones: dones,
+            self.discounts: discounts}
+        if weights is not None:
+            feed_dict[self.weights] = weights
+        _, td_errors = self.session.run([self.op, self.td_errors], feed_dict=feed_dict)
+        return td_errors
+
+    def run_loop(self, states, actions, rewards, next_states, dones, discounts, weights=None):
+        """Run one update for each of K minibatches given with a leading axis of K, returns (K, B) TD errors.
+
+        `discounts` has the shape of `rewards`.
+        """
+        feed_dict = {
+            self.loop_states: states,
+            self.loop_actions: actions,
+            self.loop_rewards: rewards,
+            self.loop_next_states: next_states,
+            self.loop_dones: dones,
+            self.loop_discounts: discounts}
+        if weights is not None:
+            feed_dict[self.loop_weights] = weights
+        return self.session.run(self.loop_td_errors, feed_dict=feed_dict)
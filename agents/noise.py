@@ -1,6 +1,5 @@
 import math
 import numpy as np
-import tensorflow as tf
 
 
 class Noise:
@@ -64,3 +63,93 @@ class OUNoise2:
 
 
 
+
+
+class VectorOUNoise:
+    """Ornstein-Uhlenbeck processes of `num_envs` environments, the rows of a (num_envs, size) state.
+
+    Gaussian increments are drawn `block_size` steps ahead per environment. `seeds` makes each environment's
+    process deterministic, whatever the other environments do: a base seed (environment i uses seed + i),
+    one seed per environment, or one np.random.RandomState per environment. Without seeds the increments
+    come from the global np.random state.
+    """
+    def __init__(self, num_envs, size, mu=None, theta=0.15, sigma=0.3, seeds=None, block_size=1024):
+        self.num_envs = num_envs
+        self.size = size
+        self.mu = np.zeros(size) if mu is None else np.asarray(mu, dtype=np.float64)
+        self.theta = theta
+        self.sigma = sigma
+        self.block_size = block_size
+        self.rngs = _random_states(seeds, num_envs)
+
+        self.state = np.empty((num_envs, size))
+        self.state[:] = self.mu
+        self._envs = np.arange(num_envs)
+        self._gaussians = np.empty((num_envs, block_size, size))
+        self._next = np.full(num_envs, block_size)
+
+    def _refill(self, envs):
+        if self.rngs is None:
+            self._gaussians[envs] = np.random.randn(len(envs), self.block_size, self.size)
+        else:
+            for env in envs:
+                self._gaussians[env] = self.rngs[env].randn(self.block_size, self.size)
+        self._next[envs] = 0
+
+    def _increments(self, envs):
+        exhausted = envs[self._next[envs] == self.block_size]
+        if len(exhausted):
+            self._refill(exhausted)
+        increments = self._gaussians[envs, self._next[envs]]
+        self._next[envs] += 1
+        return increments
+
+    def reset(self, envs=None):
+        """Reset the state of the environments `envs` (indices or a mask, by default all) to mean (mu)."""
+        self.state[slice(None) if envs is None else envs] = self.mu
+
+    def sample(self, envs=None):
+        """Update the state of the environments `envs` (indices, by default all) and return it."""
+        envs = self._envs if envs is None else np.asarray(envs)
+        state = self.state[envs]
+        state += self.theta * (self.mu - state) + self.sigma * self._increments(envs)
+        self.state[envs] = state
+        return state
+
+
+class VectorOUNoise2:
+    """OUNoise2 of `num_envs` environments, see VectorOUNoise for `seeds` and `block_size`.
+
+    As in OUNoise2, whose step counter stays at 0, the first process steps and restarts the second one on
+    every sample.
+    """
+    def __init__(self, num_envs, size, mu=None, theta=0.15, sigma=0.3, steps=100, seeds=None,
+                 block_size=1024):
+        # Both processes draw from the same per-environment streams
+        rngs = _random_states(seeds, num_envs)
+        self.n1 = VectorOUNoise(num_envs, size, mu, theta, sigma*math.sqrt(steps), rngs, block_size)
+        self.n2 = VectorOUNoise(num_envs, size, mu, theta, sigma, rngs, block_size)
+        self._envs = np.arange(num_envs)
+
+    def reset(self, envs=None):
+        """Reset the state of the environments `envs` (indices or a mask, by default all) to mean (mu)."""
+        envs = slice(None) if envs is None else envs
+        self.n1.reset(envs)
+        self.n2.state[envs] = self.n1.state[envs]
+
+    def sample(self, envs=None):
+        """Update the state of the environments `envs` (indices, by default all) and return it."""
+        envs = self._envs if envs is None else np.asarray(envs)
+        s1 = self.n1.sample(envs)
+        self.n2.state[envs] = s1
+        s2 = self.n2.sample(envs)
+        s2 += s1
+        return s2
+
+
+def _random_states(seeds, num_envs):
+    if seeds is None:
+        return None
+    if np.isscalar(seeds):
+        seeds = seeds + np.arange(num_envs)
+    return [seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed) for seed in seeds]
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+
+# In-place activations by name, as stored in policy files
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+}
+
+
+class NumpyActor:
+    """The DDPG actor network evaluated with NumPy, without a session round trip.
+
+    `weights` are the kernels and biases of the dense layers in order, as listed by Actor.weights(). By default
+    the hidden layers use ReLU and the output tanh, scaled to [action_low, action_high] like
+    Actor.create_model().
+    Activations are written into buffers kept between calls, grown to the largest batch seen, so
+    __call__() returns a view that is overwritten by the next call.
+
+    set_weights() swaps all the layers at once, so another thread may refresh the weights while acting.
+    save() writes the architecture and the weights to a single .npz policy file, which load() reads back
+    without TensorFlow.
+    """
+    def __init__(self, weights, action_low, action_high, activations=None, dtype=np.float32):
+        self.dtype = dtype
+        self.layers = None
+        self.set_weights(weights)
+
+        num_layers = len(self.layers)
+        self.activations = list(activations or ['relu'] * (num_layers - 1) + ['tanh'])
+        if len(self.activations) != num_layers:
+            raise ValueError("NumpyActor needs one activation per layer")
+        self._activations = [ACTIVATIONS[name] for name in self.activations]
+
+        num_actions = self.layers[-1][1].shape[0]
+        self.action_low = np.broadcast_to(np.asarray(action_low, dtype=dtype), (num_actions,))
+        self.action_high = np.broadcast_to(np.asarray(action_high, dtype=dtype), (num_actions,))
+        self.action_scale = (self.action_high - self.action_low) / 2
+        self.action_zero = self.action_low + self.action_scale
+
+        self._capacity = 0
+        self._buffers = None
+
+    @property
+    def num_states(self):
+        return self.layers[0][0].shape[0]
+
+    @property
+    def num_actions(self):
+        return self.layers[-1][0].shape[1]
+
+    def set_weights(self, weights):
+        """Replace the weights with copies of (kernel, bias, kernel, bias, ...)."""
+        weights = [np.array(w, dtype=self.dtype) for w in weights]
+        layers = tuple(zip(weights[0::2], weights[1::2]))
+        if self.layers is not None and [k.shape for k, _ in layers] != [k.shape for k, _ in self.layers]:
+            raise ValueError("NumpyActor weights do not match the network layout")
+        self.layers = layers
+
+    def _reserve(self, size, layers):
+        if size > self._capacity:
+            self._capacity = max(size, 2 * self._capacity)
+            self._buffers = [np.empty((self._capacity, layers[0][0].shape[0]), dtype=self.dtype)] + \
+                            [np.empty((self._capacity, kernel.shape[1]), dtype=self.dtype) for kernel, _ in layers]
+        return [buffer[:size] for buffer in self._buffers]
+
+    def __call__(self, states):
+        """Actions for a (N, num_states) batch of states, or for a single state."""
+        layers = self.layers
+        states = np.asarray(states)
+        single = states.ndim == 1
+        if single:
+            states = states[None]
+
+        buffers = self._reserve(len(states), layers)
+        x = buffers[0]
+        x[:] = states
+        for i, (kernel, bias) in enumerate(layers):
+            y = buffers[i + 1]
+            np.dot(x, kernel, out=y)
+            y += bias
+            self._activations[i](y)
+            x = y
+
+        x *= self.action_scale
+        x += self.action_zero
+        return x[0] if single else x
+
+    def save(self, path):
+        """Write the policy to the .npz file `path`, replacing it atomically."""
+        arrays = {'activations': np.array(self.activations),
+                  'action_low': self.action_low,
+                  'action_high': self.action_high}
+        for i, (kernel, bias) in enumerate(self.layers):
+            arrays['kernel_{}'.format(i)] = kernel
+            arrays['bias_{}'.format(i)] = bias
+
+        tmp_path = str(path) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Policy written by save()."""
+        with np.load(path) as data:
+            activations = [str(name) for name in data['activations']]
+            weights = []
+            for i in range(len(activations)):
+                weights += [data['kernel_{}'.format(i)], data['bias_{}'.format(i)]]
+            return cls(weights, data['action_low'], data['action_high'], activations,
+                       dtype=data['kernel_0'].dtype.type)
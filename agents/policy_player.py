@@ -0,0 +1,109 @@
+from pathlib import Path
+
+from .base_agent import BaseAgent
+from .numpy_actor import NumpyActor
+
+
+def policy_path(model_path):
+    """Path of the policy file written alongside the checkpoint `model_path`."""
+    return str(model_path) + '.policy.npz'
+
+
+def task_policy_path(task_name, directory='models'):
+    """Newest policy file of the task in `directory`, saved with the agent or by a CheckpointManager, or None."""
+    paths = [Path(policy_path(Path(directory) / (task_name + label))) for label in ('.model', '.latest')]
+    paths = [path for path in paths if path.exists()]
+    return max(paths, key=lambda path: path.stat().st_mtime) if paths else None
+
+
+class PolicyPlayer(BaseAgent):
+    """Plays the policy file of a trained agent, see NumpyActor.save(); needs neither TensorFlow nor the critic.
+
+    Loads `path`, by default the newest policy file of the task in models/, see task_policy_path().
+    """
+    def __init__(self, task, path=None):
+        super().__init__(task)
+
+        self.best_score = None
+        self.episode_score = 0.0
+        self.episode_ticks = 0
+        self.reset_episode_vars()
+        self.prev_state = None
+
+        self.episode = 1
+
+        self.num_actions = task.num_actions
+        self.num_states = task.num_states
+
+        self.policy = None
+        if path is not None:
+            self.load(path)
+        else:
+            self.load_task_agent()
+            if self.policy is None:
+                raise FileNotFoundError("No policy file for task " + task.task_name)
+
+    def reset_episode_vars(self):
+        self.episode_score = 0.0
+        self.episode_ticks = 0
+
+    def act(self, state):
+        return self.policy(state).copy()
+
+    def step(self, action, reward, next_state, done):
+        """Process state, reward, done flag, and return an action.
+
+        Params
+        ======
+        - state: current state vector as NumPy array, compatible with task's state space
+        - reward: last reward received
+        - done: whether this episode is complete
+
+        Returns
+        =======
+        - action: desired action vector as NumPy array, compatible with task's action space
+        """
+        self.episode_ticks += 1
+        self.episode_score += reward
+
+        action_str = ', '.join('{:7.3f}'.format(a) for a in action)
+        position_str = ', '.join('{:7.3f}'.format(a) for a in self.prev_state[0:6])
+
+        print('[{}] => [{}], R = {:7.3f}'.format(position_str, action_str, reward))
+
+        self.prev_state = next_state
+
+        # Output some information at the end of the episode
+        if done:
+            if self.best_score is not None:
+                self.best_score = max(self.best_score, self.episode_score)
+            else:
+                self.best_score = self.episode_score
+            print("Deep DPG episode stats: t = {:4d}, score = {:7.3f} (best = {:7.3f}), noise_scale = {}".format(
+                self.episode_ticks, self.episode_score, self.best_score, 0))# self.noise_scale))  # [debug]
+            self.reset_episode_vars()
+            self.episode += 1
+
+        return action
+
+    def reset_episode(self):
+        self.episode_score = 0.0
+        self.episode_ticks = 0
+        self.prev_state = self.task.reset()
+        return self.prev_state
+
+    @property
+    def noise_scale(self):
+        return 0
+
+    def load(self, path):
+        self.policy = NumpyActor.load(path)
+
+    def save(self, path):
+        # Can't save anything
+        pass
+
+    def load_task_agent(self):
+        path = task_policy_path(self.task.task_name, Path.cwd() / 'models')
+        if path is not None:
+            self.load(str(path))
@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+
+
+class BatchPrefetcher:
+    """Samples training batches from a replay buffer on a background thread.
+
+    Up to `num_batches` batches wait in a bounded queue, so get() only dequeues while the next batches are
+    assembled during the network updates. The batches are written into a fixed pool of arrays from
+    ReplayBuffer.new_batch(): a batch returned by get() stays valid until the next call to get().
+    With `n_step` > 1 the batches are the ones of sample_n_step(). An exception while sampling stops the
+    thread and is raised again by get().
+    """
+    def __init__(self, replay_buffer, batch_size, num_batches=4, n_step=1, gamma=0.99):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.n_step = n_step
+        self.gamma = gamma
+
+        # num_batches in the queue, one held by the consumer and one being filled
+        self._pool_size = num_batches + 2
+        self._pool = None
+        self.error = None
+        self._queue = queue.Queue(maxsize=num_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _sample(self, out):
+        if self.n_step > 1:
+            return self.replay_buffer.sample_n_step(self.batch_size, self.n_step, self.gamma, out)
+        return self.replay_buffer.sample(self.batch_size, out)
+
+    def _run(self):
+        try:
+            self._prefetch()
+        except Exception as e:
+            # Queued after the batches sampled before it
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def _prefetch(self):
+        i = 0
+        while not self._stop.is_set():
+            if len(self.replay_buffer) < self.batch_size:
+                time.sleep(0.001)
+                continue
+            if self._pool is None:
+                self._pool = [self.replay_buffer.new_batch(self.batch_size, self.n_step > 1)
+                              for _ in range(self._pool_size)]
+
+            batch = self._sample(self._pool[i])
+            i = (i + 1) % self._pool_size
+            self._put(batch)
+
+    def get(self):
+        """Next batch, in the format of the replay buffer's sample() or sample_n_step()."""
+        if self.error is None:
+            batch = self._queue.get()
+            if not isinstance(batch, Exception):
+                return batch
+            self.error = batch
+        raise RuntimeError("Sampling a batch failed") from self.error
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
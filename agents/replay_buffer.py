@@ -1,21 +1,574 @@
-import random
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
 
 
 class ReplayBuffer:
+    """Ring buffer of transitions stored column-wise in preallocated NumPy arrays.
+
+    The columns (states, actions, rewards, next_states, dones) are allocated on the first insert, with the
+    shapes of the first transition. sample() writes into output arrays which are reused by the next call, or
+    into `out` arrays created by new_batch(). Inserting and sampling hold `lock`, so a BatchPrefetcher thread
+    can sample while transitions are added.
+
+    Every transition remembers its successor in the episode for n-step returns: the next transition of the
+    same stream, e.g. environment, if its state equals the next state. Transitions are added with the ids of
+    their streams, non-negative integers; the rows of add_batch() default to streams 0 to N - 1.
+    """
+    dtype = np.float32
+    prioritized = False
+    # Whether sample_n_step() is supported
+    linked = True
+
     def __init__(self, max_size = 1024):
-        self.data = []
         self.max_size = max_size
         self.circ_insert_idx = 0
+        self.size = 0
+        self.num_inserted = 0
+        self.columns = None
+        self._batch = None
+        self.lock = threading.RLock()
+        # Insertion number of the last transition of each stream, -1 before the first one
+        self.stream_serials = np.full(0, -1, dtype=np.int64)
 
-    def add(self, data):
-        if len(self.data) < self.max_size:
-            self.data.append(data)
-        else:
-            self.data[self.circ_insert_idx] = data
-            self.circ_insert_idx = (self.circ_insert_idx + 1) % self.max_size
+    def _new_column(self, name, shape, dtype):
+        return np.zeros((self.max_size,) + shape, dtype=dtype)
+
+    def _allocate(self, state, action):
+        state_shape = np.shape(state)
+        action_shape = np.shape(action)
+        self.columns = (
+            self._new_column('states', state_shape, self.dtype),
+            self._new_column('actions', action_shape, self.dtype),
+            self._new_column('rewards', (1,), self.dtype),
+            self._new_column('next_states', state_shape, self.dtype),
+            self._new_column('dones', (1,), self.dtype),
+        )
+        # Insertion number of each row, and the difference to the one of its successor (0 if none)
+        self.serials = self._new_column('serials', (), np.int64)
+        self.successors = self._new_column('successors', (), np.int32)
+
+    @property
+    def states(self):
+        return self.columns[0]
+
+    @property
+    def actions(self):
+        return self.columns[1]
+
+    @property
+    def rewards(self):
+        return self.columns[2]
+
+    @property
+    def next_states(self):
+        return self.columns[3]
+
+    @property
+    def dones(self):
+        return self.columns[4]
+
+    def add(self, data, stream=0):
+        """Add one [state, action, reward, next_state, done] transition of `stream`."""
+        self.add_batch(*[np.asarray(value)[None] for value in data], streams=[stream])
+
+    def add_batch(self, states, actions, rewards, next_states, dones, streams=None):
+        """Add N transitions given as arrays with a leading axis of N, of N distinct `streams`."""
+        n = len(states)
+        if n == 0:
+            return
+        streams = np.arange(n) if streams is None else np.asarray(streams)
+        with self.lock:
+            if self.columns is None:
+                self._allocate(states[0], actions[0])
+
+            indices = self._next_indices(n)
+            first = n - len(indices)
+            serials = self.num_inserted + first + np.arange(len(indices))
+            self._link(serials, streams[first:], np.asarray(states)[first:])
+
+            for column, values in zip(self.columns, (states, actions, rewards, next_states, dones)):
+                values = np.asarray(values)[first:]
+                column[indices] = values.reshape((len(indices),) + column.shape[1:])
+            self.serials[indices] = serials
+            self.successors[indices] = 0
+            self._advance(n)
+
+    def _link(self, serials, streams, states):
+        # Point the last stored transition of each stream at the new one, before the batch overwrites any row
+        if len(self.stream_serials) <= streams.max():
+            grown = np.full(streams.max() + 1, -1, dtype=np.int64)
+            grown[:len(self.stream_serials)] = self.stream_serials
+            self.stream_serials = grown
+
+        previous = self.stream_serials[streams]
+        rows = previous % self.max_size
+        ok = ((previous > serials[-1] - self.max_size) & (self.serials[rows] == previous) &
+              (self.dones[rows, 0] == 0))
+        if ok.any():
+            n = len(serials)
+            states = states.astype(self.dtype).reshape(n, -1)
+            ok[ok] = np.all(self.next_states[rows[ok]].reshape(-1, states.shape[1]) == states[ok], axis=1)
+            self.successors[rows[ok]] = (serials - previous)[ok]
+        self.stream_serials[streams] = serials
+
+    def _successors(self, rows):
+        """Rows of the next transitions of the episodes, and whether they exist."""
+        serials = self.serials[rows] + self.successors[rows]
+        next_rows = serials % self.max_size
+        ok = (self.successors[rows] > 0) & (self.serials[next_rows] == serials)
+        return next_rows, ok
+
+    def _gather_next_states(self, rows, out):
+        np.take(self.next_states, rows, axis=0, out=out)
+
+    def _next_indices(self, n):
+        # Rows written by the next n inserts, only the last max_size of a larger batch survive
+        first = max(0, n - self.max_size)
+        return (self.circ_insert_idx + first + np.arange(n - first)) % self.max_size
+
+    def _advance(self, n):
+        self.circ_insert_idx = (self.circ_insert_idx + n) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+        self.num_inserted += n
+
+    def sample_indices(self, size=64):
+        return np.random.randint(0, self.size, size)
+
+    def flush(self):
+        """Write the buffer to its backing storage, if it has one."""
+        pass
+
+    def sample(self, size=64, out=None):
+        """Sample `size` transitions uniformly, with replacement.
+
+        Returns (states, actions, rewards, next_states, dones) arrays, rewards and dones of shape (size, 1).
+        Without `out` the arrays are overwritten by the next call to sample().
+        """
+        with self.lock:
+            return self.gather(self.sample_indices(size), out)
 
-    def sample(self, size=64):
-        return random.sample(self.data, size)
+    def sample_n_step(self, size=64, n=3, gamma=0.99, out=None):
+        """Sample `size` transitions uniformly and extend them to n-step transitions, see gather_n_step()."""
+        with self.lock:
+            return self.gather_n_step(self.sample_indices(size), n, gamma, out)
+
+    def new_batch(self, size, n_step=False):
+        """Output arrays for `size` transitions, with the discounts column of n-step batches if `n_step`."""
+        shapes = (self.states.shape[1:], self.actions.shape[1:], (1,), self.states.shape[1:], (1,))
+        if n_step:
+            shapes += ((1,),)
+        return tuple(np.empty((size,) + shape, dtype=self.dtype) for shape in shapes)
+
+    def _output(self, size, out):
+        if out is not None:
+            return out
+        if self._batch is None or len(self._batch[0]) != size:
+            self._batch = self.new_batch(size)
+        return self._batch
+
+    def gather(self, indices, out=None):
+        """Copy the transitions at `indices` into the output arrays and return them."""
+        out = self._output(len(indices), out)
+        for column, values in zip(self.columns, out):
+            np.take(column, indices, axis=0, out=values)
+        return out[:5]
+
+    def gather_n_step(self, indices, n, gamma, out=None):
+        """n-step transitions starting at `indices`.
+
+        Returns (states, actions, returns, next_states, dones, discounts): the discounted sum of up to n rewards,
+        cut at the end of the episode or of the stored data, with the next state and done of the last step
+        taken and discounts = gamma^steps for bootstrapping, all (size, 1) except the states and actions.
+        """
+        rows = np.asarray(indices)
+        last = rows
+        returns = self.rewards[rows, 0].astype(np.float64)
+        steps = np.ones(len(rows), dtype=np.int64)
+        alive = self.dones[rows, 0] == 0
+
+        # Walks all samples one step at a time, n - 1 vector steps in total
+        for k in range(1, n):
+            rows, ok = self._successors(rows)
+            alive &= ok
+            if not alive.any():
+                break
+            returns += np.where(alive, gamma**k * self.rewards[rows, 0], 0.0)
+            steps += alive
+            last = np.where(alive, rows, last)
+            alive &= self.dones[rows, 0] == 0
+
+        states, actions, rewards, next_states, dones = self.gather(indices, out)
+        rewards[:, 0] = returns
+        self._gather_next_states(last, next_states)
+        np.take(self.dones, last, axis=0, out=dones)
+        if out is None:
+            discounts = np.empty((len(steps), 1), dtype=self.dtype)
+        else:
+            discounts = out[5]
+        discounts[:, 0] = gamma**steps
+        return states, actions, rewards, next_states, dones, discounts
 
     def __len__(self):
-        return len(self.data)
\ No newline at end of file
+        return self.size
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """ReplayBuffer whose columns are memory-mapped .npy files in the directory `path`.
+
+    The capacity is bounded by the disk, not the RAM: the OS pages rows in and out as they are used. The ring
+    index and fill count are stored in meta.json by flush(), which runs every `flush_every` inserted transitions
+    and when the agent is saved. Opening an existing directory continues from the last flush.
+    """
+    COLUMNS = ('states', 'actions', 'rewards', 'next_states', 'dones')
+    LINKS = ('serials', 'successors')
+
+    def __init__(self, path, max_size = 1000000, flush_every=10000):
+        super().__init__(max_size)
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self._unflushed = 0
+
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            with meta_path.open() as f:
+                meta = json.load(f)
+            if meta['max_size'] != max_size:
+                raise ValueError("Replay buffer in {} holds {} transitions, not {}".format(
+                    self.path, meta['max_size'], max_size))
+            self.columns = tuple(self._open_column(name) for name in self.COLUMNS)
+            self.serials, self.successors = (self._open_column(name) for name in self.LINKS)
+            self.circ_insert_idx = meta['circ_insert_idx']
+            self.size = meta['size']
+            self.num_inserted = meta['num_inserted']
+
+    @classmethod
+    def for_task(cls, task, max_size = 1000000, flush_every=10000):
+        """Buffer stored in models/<task name>.replay, next to the saved agent."""
+        return cls(Path.cwd() / 'models' / (task.task_name + '.replay'), max_size, flush_every)
+
+    def _open_column(self, name):
+        return np.lib.format.open_memmap(str(self.path / (name + '.npy')), mode='r+')
+
+    def _new_column(self, name, shape, dtype):
+        return np.lib.format.open_memmap(str(self.path / (name + '.npy')), mode='w+', dtype=dtype,
+                                         shape=(self.max_size,) + shape)
+
+    def _allocate(self, state, action):
+        self.path.mkdir(parents=True, exist_ok=True)
+        super()._allocate(state, action)
+        self.flush()
+
+    def _advance(self, n):
+        super()._advance(n)
+        self._unflushed += n
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.columns is None:
+            return
+        with self.lock:
+            for column in self.columns + (self.serials, self.successors):
+                column.flush()
+
+            # The metadata is replaced atomically after the data, a crash never leaves it ahead of the columns
+            meta = {'max_size': self.max_size, 'circ_insert_idx': self.circ_insert_idx, 'size': self.size,
+                    'num_inserted': self.num_inserted}
+            tmp_path = self.path / 'meta.json.tmp'
+            with tmp_path.open('w') as f:
+                json.dump(meta, f)
+            os.replace(str(tmp_path), str(self.path / 'meta.json'))
+            self._unflushed = 0
+
+
+class EpisodeReplayBuffer(ReplayBuffer):
+    """ReplayBuffer storing every observation of an episode once.
+
+    Slot i holds an observation with the action, reward and done taken from it; its next state is the
+    observation of slot i + 1. A transition which does not continue the previous one starts in a new slot, so
+    each episode costs one extra slot for its last next state. The slots are split into `num_streams` rings, one
+    per parallel environment: add() feeds `stream`, add_batch() one transition of each of `streams`, by default
+    streams 0 to N - 1.
+
+    Observations are kept as `storage_dtype` (float32 or float16) and upcast to float32 by sample().
+    """
+    def __init__(self, max_size = 1024, num_streams=1, storage_dtype=np.float32):
+        super().__init__(max_size)
+        self.num_streams = num_streams
+        self.storage_dtype = storage_dtype
+        self.stream_size = max_size // num_streams
+        self.offsets = np.arange(num_streams) * self.stream_size
+        # Local slot of the last next state of each stream, the first transition goes to slot 0
+        self.stream_idx = np.full(num_streams, self.stream_size - 1)
+        self.stream_open = np.zeros(num_streams, dtype=bool)
+        self.last_next_states = None
+
+    def _allocate(self, state, action):
+        num_slots = self.stream_size * self.num_streams
+        self.observations = np.zeros((num_slots,) + np.shape(state), dtype=self.storage_dtype)
+        self.valid = np.zeros(num_slots, dtype=bool)
+        self.columns = (
+            self.observations,
+            np.zeros((num_slots,) + np.shape(action), dtype=self.dtype),
+            np.zeros((num_slots, 1), dtype=self.dtype),
+            np.zeros((num_slots, 1), dtype=self.dtype),
+        )
+        # Full precision copies, compared to the next states to detect continuing episodes
+        self.last_next_states = np.zeros((self.num_streams,) + np.shape(state))
+
+    @property
+    def next_states(self):
+        # Building the column would copy every observation, the next states are read by _gather_next_states()
+        raise AttributeError("EpisodeReplayBuffer stores no next_states column")
+
+    @property
+    def dones(self):
+        return self.columns[3]
+
+    def _next_slots(self, slots):
+        return slots - slots % self.stream_size + (slots + 1) % self.stream_size
+
+    def _successors(self, slots):
+        # A valid next slot continues the episode, a new episode starts after an invalid slot
+        next_slots = self._next_slots(slots)
+        return next_slots, self.valid[next_slots]
+
+    def _gather_next_states(self, slots, out):
+        out[...] = self.observations[self._next_slots(slots)]
+
+    def _invalidate(self, slots):
+        self.size -= np.count_nonzero(self.valid[slots])
+        self.valid[slots] = False
+
+    def add(self, data, stream=0):
+        state, action, reward, next_state, done = data
+        self._add(np.array([stream]), np.asarray(state)[None], np.asarray(action)[None], np.asarray(reward),
+                  np.asarray(next_state)[None], np.asarray(done))
+
+    def add_batch(self, states, actions, rewards, next_states, dones, streams=None):
+        """Add one transition of each of N distinct `streams`, given as arrays with a leading axis of N."""
+        streams = np.arange(len(states)) if streams is None else np.asarray(streams)
+        self._add(streams, np.asarray(states), np.asarray(actions), np.asarray(rewards),
+                  np.asarray(next_states), np.asarray(dones))
+
+    def _add(self, streams, states, actions, rewards, next_states, dones):
+        with self.lock:
+            self._add_locked(streams, states, actions, rewards, next_states, dones)
+
+    def _add_locked(self, streams, states, actions, rewards, next_states, dones):
+        if self.columns is None:
+            self._allocate(states[0], actions[0])
+
+        flat = (len(streams), -1)
+        continues = self.stream_open[streams] & np.all(
+            states.reshape(flat) == self.last_next_states[streams].reshape(flat), axis=1)
+        local = np.where(continues, self.stream_idx[streams], (self.stream_idx[streams] + 1) % self.stream_size)
+        slots = self.offsets[streams] + local
+        next_slots = self._next_slots(slots)
+
+        # A continuing transition starts from the last next state, already stored in its slot
+        new_slots = slots[~continues]
+        self._invalidate(new_slots)
+        self._invalidate(next_slots)
+        self.observations[new_slots] = states[~continues]
+        self.observations[next_slots] = next_states
+
+        self.columns[1][slots] = actions.reshape((len(slots),) + self.columns[1].shape[1:])
+        self.columns[2][slots, 0] = rewards
+        self.columns[3][slots, 0] = dones
+        self.valid[slots] = True
+        self.size += len(slots)
+
+        self.stream_idx[streams] = (local + 1) % self.stream_size
+        self.stream_open[streams] = ~dones.astype(bool)
+        self.last_next_states[streams] = next_states
+
+    def sample_indices(self, size=64):
+        num_slots = len(self.valid)
+        if self.size < num_slots // 2:
+            # Mostly empty, pick among the valid slots directly
+            return np.random.choice(np.flatnonzero(self.valid), size)
+
+        indices = np.random.randint(0, num_slots, size)
+        invalid = ~self.valid[indices]
+        while invalid.any():
+            indices[invalid] = np.random.randint(0, num_slots, np.count_nonzero(invalid))
+            invalid = ~self.valid[indices]
+        return indices
+
+    def gather(self, indices, out=None):
+        out = self._output(len(indices), out)
+        states, actions, rewards, next_states, dones = out[:5]
+        states[...] = self.observations[indices]
+        self._gather_next_states(indices, next_states)
+        np.take(self.columns[1], indices, axis=0, out=actions)
+        np.take(self.columns[2], indices, axis=0, out=rewards)
+        np.take(self.columns[3], indices, axis=0, out=dones)
+        return out[:5]
+
+
+class SegmentTree:
+    """Array segment tree over `capacity` leaves, reduced with `operation` (np.add, np.minimum, ...).
+
+    Node 1 is the root, the children of node i are 2i and 2i + 1, leaf j is node capacity + j.
+    """
+    def __init__(self, capacity, operation, neutral):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.tree = np.full(2 * self.capacity, neutral, dtype=np.float64)
+
+    @property
+    def root(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def update(self, indices, values):
+        """Set the leaves at `indices` and recompute their ancestors, one tree level at a time."""
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        self.tree[nodes] = values
+        # Repeated nodes are recomputed with the same value, no need to deduplicate
+        while len(nodes) and nodes[0] > 1:
+            nodes >>= 1
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, 0.0)
+
+    def find(self, values):
+        """Leaf indices at which the running sum of the leaves reaches each of `values`."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        # All leaves are at the same depth, the whole batch descends together
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            right = values > left_sums
+            values -= left_sums * right
+            nodes = left + right
+        return nodes - self.capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer sampling transitions by their last TD error.
+
+    From paper by Schaul, Tom et al. "Prioritized Experience Replay."
+    https://arxiv.org/pdf/1511.05952.pdf
+
+    In the 'proportional' mode a transition is sampled with probability proportional to (|TD error| + eps)^alpha,
+    through a sum tree. In the 'rank' mode the probability is proportional to (1 / rank)^alpha, the ranks are
+    recomputed by sorting every `sort_every` samples. New transitions get the largest TD error seen so far; those
+    added since the last sort rank first until the next one.
+
+    sample() returns the columns of ReplayBuffer.sample() followed by the importance-sampling weights (size, 1)
+    and the sampled indices, which are passed back to update_priorities() with the new TD errors. The exponent
+    of the weights anneals from `beta` to 1 over `beta_steps` samples.
+    """
+    prioritized = True
+
+    def __init__(self, max_size = 1024, mode='proportional', alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6,
+                 sort_every=1000):
+        super().__init__(max_size)
+        if mode not in ('proportional', 'rank'):
+            raise ValueError("Unknown prioritization mode '{}'".format(mode))
+
+        self.mode = mode
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.num_samples = 0
+        self.max_error = 1.0
+
+        if mode == 'proportional':
+            self.sums = SumTree(max_size)
+            self.mins = SegmentTree(max_size, np.minimum, np.inf)
+        else:
+            self.errors = np.zeros(max_size)
+            self.sort_every = sort_every
+            self._order = None
+            self._sorted_at = 0
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta_start + (1.0 - self.beta_start) * self.num_samples / self.beta_steps)
+
+    def _set_errors(self, indices, errors):
+        if self.mode == 'proportional':
+            priorities = (errors + self.eps) ** self.alpha
+            self.sums.update(indices, priorities)
+            self.mins.update(indices, priorities)
+        else:
+            self.errors[indices] = errors
+
+    def add_batch(self, states, actions, rewards, next_states, dones, streams=None):
+        with self.lock:
+            indices = self._next_indices(len(states))
+            super().add_batch(states, actions, rewards, next_states, dones, streams)
+            if len(indices):
+                self._set_errors(indices, self.max_error)
+
+    def update_priorities(self, indices, td_errors):
+        errors = np.abs(np.asarray(td_errors, dtype=np.float64)).ravel()
+        with self.lock:
+            self.max_error = max(self.max_error, errors.max())
+            self._set_errors(indices, errors)
+
+    def _sort(self):
+        self._order = np.argsort(-self.errors[:self.size], kind='stable')
+        self._sorted_at = self.num_samples
+        self._rank_distribution()
+
+    def _extend_order(self):
+        # The rows added since the last sort have the largest error, they rank first
+        self._order = np.concatenate((np.arange(len(self._order), self.size), self._order))
+        self._rank_distribution()
+
+    def _rank_distribution(self):
+        pmf = (1.0 / np.arange(1, self.size + 1)) ** self.alpha
+        self._pmf = pmf / pmf.sum()
+        self._cdf = np.cumsum(self._pmf)
+
+    def sample_prioritized(self, size=64):
+        """Sample `size` indices, returns them with their importance-sampling weights."""
+        # Stratified: one uniform sample from each of `size` equal segments of the distribution
+        u = (np.arange(size) + np.random.uniform(size=size)) / size
+
+        if self.mode == 'proportional':
+            total = self.sums.root
+            indices = np.minimum(self.sums.find(u * total), self.size - 1)
+            probabilities = self.sums[indices] / total
+            min_probability = self.mins.root / total
+        else:
+            if self._order is None or self.num_samples - self._sorted_at >= self.sort_every:
+                self._sort()
+            elif len(self._order) != self.size:
+                self._extend_order()
+            ranks = np.minimum(np.searchsorted(self._cdf, u, side='right'), len(self._order) - 1)
+            indices = self._order[ranks]
+            probabilities = self._pmf[ranks]
+            min_probability = self._pmf[-1]
+
+        self.num_samples += 1
+        # (N P(i))^-beta normalized by the largest weight, the one of the least probable transition
+        weights = (probabilities / min_probability) ** -self.beta
+        return indices, weights
+
+    def sample(self, size=64, out=None):
+        with self.lock:
+            indices, weights = self.sample_prioritized(size)
+            return self.gather(indices, out) + (weights[:, None].astype(self.dtype), indices)
+
+    def sample_n_step(self, size=64, n=3, gamma=0.99, out=None):
+        with self.lock:
+            indices, weights = self.sample_prioritized(size)
+            return self.gather_n_step(indices, n, gamma, out) + (weights[:, None].astype(self.dtype), indices)
@@ -0,0 +1,118 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from .replay_buffer import ReplayBuffer
+
+# Header of the shared block: layout, then (published count, end of the rows being written) per writer
+H_MAX_SIZE, H_NUM_WRITERS, H_NUM_STATES, H_NUM_ACTIONS = range(4)
+HEADER_SIZE = 4
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """ReplayBuffer in a shared memory block, written by several processes and sampled by others.
+
+    The rows are split into `num_writers` ring segments, writer k owns segment k, so writes need no lock. A
+    writer first announces the rows it is about to overwrite, writes them and then publishes its new count of
+    inserted transitions. Readers sample only published rows and resample those a writer has started to
+    overwrite meanwhile. Counters are single aligned int64 values written by one process.
+
+    The block is a multiprocessing.RawArray, like the buffers of SubprocVectorTask. The creating process writes
+    as writer `writer`; it passes `shared` to the other processes when starting them, which open it with
+    attach(shared, writer), readers pass writer=None. States and actions are flat vectors of num_states and
+    num_actions values. Transitions are not linked, so n-step sampling is not supported.
+    """
+    linked = False
+
+    def __init__(self, max_size = 1024, num_states=1, num_actions=1, num_writers=1, writer=0):
+        super().__init__(max_size)
+        self.max_size = max_size - max_size % num_writers
+        header_size = HEADER_SIZE + 2 * num_writers
+        row_size = 2 * num_states + num_actions + 2
+        nbytes = header_size * 8 + self.max_size * row_size * np.dtype(self.dtype).itemsize
+        self.shared = mp.RawArray('b', nbytes)
+
+        header = np.frombuffer(self.shared, dtype=np.int64, count=header_size)
+        header[:] = 0
+        header[[H_MAX_SIZE, H_NUM_WRITERS, H_NUM_STATES, H_NUM_ACTIONS]] = (
+            self.max_size, num_writers, num_states, num_actions)
+        self._map(writer)
+
+    @classmethod
+    def attach(cls, shared, writer=None):
+        """Open the buffer whose `shared` block was passed by the creating process."""
+        self = cls.__new__(cls)
+        ReplayBuffer.__init__(self)
+        self.shared = shared
+        self._map(writer)
+        return self
+
+    def _map(self, writer):
+        layout = np.frombuffer(self.shared, dtype=np.int64, count=HEADER_SIZE)
+        self.max_size, self.num_writers, num_states, num_actions = (int(value) for value in layout)
+        self.segment_size = self.max_size // self.num_writers
+        self.writer = writer
+
+        header = np.frombuffer(self.shared, dtype=np.int64, count=HEADER_SIZE + 2 * self.num_writers)
+        self.counts = header[HEADER_SIZE::2]
+        self.writing = header[HEADER_SIZE + 1::2]
+
+        offset = header.nbytes
+        columns = []
+        for shape in ((num_states,), (num_actions,), (1,), (num_states,), (1,)):
+            size = self.max_size * int(np.prod(shape))
+            column = np.frombuffer(self.shared, dtype=self.dtype, count=size, offset=offset)
+            offset += column.nbytes
+            columns.append(column.reshape((self.max_size,) + shape))
+        self.columns = tuple(columns)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, streams=None):
+        if self.writer is None:
+            raise RuntimeError("SharedReplayBuffer attached without a writer index is read-only")
+        n = len(states)
+        if n == 0:
+            return
+
+        first = max(0, n - self.segment_size)
+        count = int(self.counts[self.writer])
+        serials = count + first + np.arange(n - first)
+        rows = self.writer * self.segment_size + serials % self.segment_size
+
+        self.writing[self.writer] = count + n
+        for column, values in zip(self.columns, (states, actions, rewards, next_states, dones)):
+            values = np.asarray(values)[first:]
+            column[rows] = values.reshape((len(rows),) + column.shape[1:])
+        self.counts[self.writer] = count + n
+
+    def __len__(self):
+        return int(np.minimum(self.counts, self.segment_size).sum())
+
+    def _sample_serials(self, counts, size):
+        sizes = np.minimum(counts, self.segment_size)
+        u = np.random.randint(0, sizes.sum(), size)
+        segments = np.searchsorted(np.cumsum(sizes), u, side='right')
+        ages = u - (np.cumsum(sizes) - sizes)[segments] + 1
+        return segments, counts[segments] - ages
+
+    def sample(self, size=64, out=None):
+        out = self._output(size, out)
+        pending = np.arange(size)
+        while len(pending):
+            segments, serials = self._sample_serials(self.counts.copy(), len(pending))
+            rows = segments * self.segment_size + serials % self.segment_size
+            for column, values in zip(self.columns, out):
+                values[pending] = column[rows]
+
+            # Keep the rows no writer has started to overwrite while they were copied
+            overwritten = serials < self.writing[segments] - self.segment_size
+            pending = pending[overwritten]
+        return out[:5]
+
+    def sample_n_step(self, size=64, n=3, gamma=0.99, out=None):
+        raise NotImplementedError("SharedReplayBuffer does not link transitions for n-step returns")
+
+    def close(self):
+        """Drop the views of the shared block, which is freed once no process holds it."""
+        self.columns = self.counts = self.writing = None
+        self._batch = None
+        self.shared = None
@@ -0,0 +1,28 @@
+class TrainingSchedule:
+    """Decides how many training updates follow the environment steps.
+
+    Runs `updates` updates every `every` environment steps, counting every transition of vectorized
+    environments, so updates / every is the update-to-data ratio. Nothing is trained, nor counted, before the
+    replay buffer holds `warmup` transitions. With `per_episode` the updates due are deferred to the end of
+    the episode. With `fused` the updates due at once run in a single graph loop on minibatches sampled
+    together, see TrainStep.run_loop().
+    """
+    def __init__(self, updates=1, every=1, warmup=0, per_episode=False, fused=False):
+        self.updates = updates
+        self.every = every
+        self.warmup = warmup
+        self.per_episode = per_episode
+        self.fused = fused
+        self.pending_steps = 0
+
+    def updates_due(self, num_steps, buffer_size, episode_done=False):
+        """Count `num_steps` environment steps, returns the number of updates to run now."""
+        if buffer_size < self.warmup:
+            return 0
+        self.pending_steps += num_steps
+        if self.per_episode and not episode_done:
+            return 0
+
+        cycles = self.pending_steps // self.every
+        self.pending_steps -= cycles * self.every
+        return cycles * self.updates
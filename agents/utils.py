@@ -2,9 +2,9 @@ import numpy as np
 import tensorflow as tf
 
 
-def scope_variables_mapping(from_scope_name, to_scope_name):
+def scope_variables_mapping(from_scope_name, to_scope_name, to_collection=tf.GraphKeys.TRAINABLE_VARIABLES):
     vars_from = {var.name[len(from_scope_name) + 1:]: var for var in tf.trainable_variables(from_scope_name)}
-    vars_to = {var.name[len(to_scope_name) + 1:]: var for var in tf.trainable_variables(to_scope_name)}
+    vars_to = {var.name[len(to_scope_name) + 1:]: var for var in tf.get_collection(to_collection, to_scope_name)}
 
     mapped_names = set(vars_from.keys()).intersection(set(vars_to.keys()))
 
@@ -0,0 +1,68 @@
+import time
+import numpy as np
+
+import physics_kernels
+from physics_sim import PhysicsSim
+
+
+def steps_per_second(sim, step, num_steps=20000):
+    rotor_speeds = np.array([404.0, 404.0, 404.0, 404.0])
+    sim.reset()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step(rotor_speeds)
+        if sim.done:
+            sim.reset()
+    return num_steps / (time.perf_counter() - start)
+
+
+sim = PhysicsSim(runtime=1e9, use_jit=False)
+python = steps_per_second(sim, sim.next_timestep)
+
+print('{:24s} {:>12s}'.format('step', 'steps/sec'))
+print('{:24s} {:12.0f}'.format('python kernel', python))
+
+if physics_kernels.HAS_JIT:
+    sim = PhysicsSim(runtime=1e9, use_jit=True)
+    sim.next_timestep(np.array([404.0, 404.0, 404.0, 404.0]))  # compile or load from the cache
+    jit = steps_per_second(sim, sim.next_timestep)
+    print('{:24s} {:12.0f}  (x{:.1f})'.format('compiled kernel', jit, jit / python))
+
+
+# Accuracy against a high resolution reference trajectory. Rotor speeds change every 0.1 s, coarser control
+# steps hold them for the whole step.
+def trajectory(control_dt, **kwargs):
+    np.random.seed(0)
+    rotor_speeds = 404.0 + np.random.uniform(-3.0, 3.0, (30, 4))
+    repeat = int(round(0.1 / control_dt))
+    sim = PhysicsSim(np.array([0.0, 0.0, 50.0, 0.0, 0.0, 0.0]), runtime=1e9, use_jit=False, dt=control_dt, **kwargs)
+    positions = []
+    start = time.perf_counter()
+    for speeds in rotor_speeds:
+        for _ in range(repeat):
+            sim.next_timestep(speeds)
+        positions.append(sim.pose[:3].copy())
+    return np.array(positions), time.perf_counter() - start, len(rotor_speeds) * repeat
+
+
+# The quaternion attitude treats angular_v as body rates, so it is compared against its own reference
+reference = {attitude: trajectory(0.1, integrator='rk4', substeps=500, attitude=attitude)[0]
+             for attitude in ('euler', 'quaternion')}
+
+print('')
+print('{:14s} {:>10s} {:>8s} {:>8s} {:>14s} {:>10s}'.format(
+    'integrator', 'attitude', 'dt', 'substeps', 'max error, m', 'ms per 3 s'))
+for integrator, attitude, control_dt, substeps in [
+        ('semi_explicit', 'euler', 1 / 50.0, 1),
+        ('semi_explicit', 'euler', 0.1, 1),
+        ('semi_explicit', 'euler', 0.1, 5),
+        ('euler', 'euler', 1 / 50.0, 1),
+        ('semi_implicit', 'euler', 1 / 50.0, 1),
+        ('rk4', 'euler', 0.1, 1),
+        ('rk4', 'euler', 0.1, 4),
+        ('rk4', 'quaternion', 0.1, 1),
+        ('semi_explicit', 'quaternion', 1 / 50.0, 1)]:
+    positions, elapsed, steps = trajectory(control_dt, integrator=integrator, substeps=substeps, attitude=attitude)
+    error = np.abs(positions - reference[attitude]).max()
+    print('{:14s} {:>10s} {:8.3f} {:8d} {:14.2e} {:10.2f}'.format(
+        integrator, attitude, control_dt, substeps, error, elapsed * 1000))
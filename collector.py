@@ -0,0 +1,129 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from agents.noise import VectorOUNoise2
+
+
+class PipelinedCollector:
+    """Collects experience from groups of vectorized environments in a pipeline.
+
+    While the actor evaluates the states of one group, the simulators of the other groups are stepping on
+    worker threads. TensorFlow, the compiled step kernel and SubprocVectorTask all release the GIL, so
+    inference and simulation overlap. Transitions stream into the agent's replay buffer through a bounded
+    queue drained by a separate thread. An exception of that thread is raised again by collect().
+
+    Params
+    ======
+        agent: DeepDPGAgent providing act_batch(), train() and the replay buffer
+        groups: VectorTask or SubprocVectorTask instances, at least two for any overlap
+        queue_size: number of (group, tick) batches of transitions which may wait for the replay buffer, each
+            environment is a stream of the buffer, numbered consecutively across the groups
+        train: run the updates of the agent's TrainingSchedule for the steps of every group tick, an episode
+            ending in any environment of the group ends the episode of a per_episode schedule
+        seed: base seed of the exploration noise, consecutive per environment across the groups
+    """
+    def __init__(self, agent, groups, queue_size=16, train=True, theta=0.15, sigma=0.2, seed=None):
+        self.agent = agent
+        self.groups = groups
+        self.train = train
+
+        offsets = np.cumsum([0] + [group.num_envs for group in groups])
+        self.streams = [offset + np.arange(group.num_envs) for group, offset in zip(groups, offsets)]
+        self.noise = [VectorOUNoise2(group.num_envs, group.num_actions, theta=theta, sigma=sigma,
+                                     seeds=None if seed is None else seed + offset)
+                      for group, offset in zip(groups, offsets)]
+        self.episode_scores = [np.zeros(group.num_envs) for group in groups]
+        self.completed_scores = []
+        self.ticks = 0
+        self._states = None
+        self.error = None
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._consumer = threading.Thread(target=self._consume, daemon=True)
+        self._consumer.start()
+        self._pool = ThreadPoolExecutor(max_workers=len(groups))
+
+    def _consume(self):
+        try:
+            while True:
+                transitions = self._queue.get()
+                if transitions is None:
+                    break
+                self.agent.replay_buffer.add_batch(*transitions)
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        """Raise the exception which stopped the thread adding the transitions to the replay buffer, if any."""
+        if self.error is not None:
+            raise RuntimeError("Adding transitions to the replay buffer failed") from self.error
+
+    def _put(self, transitions):
+        while True:
+            try:
+                self._queue.put(transitions, timeout=0.1)
+                return
+            except queue.Full:
+                self.check()
+
+    def _act(self, g, states):
+        noise = self.noise[g].sample()
+        return self.agent.act_batch(states, noise)
+
+    def collect(self, num_ticks):
+        """Step every group `num_ticks` times, returns the scores of the episodes finished meanwhile.
+
+        Episodes carry over between calls.
+        """
+        # Steps are only submitted for ticks which wait for them
+        if num_ticks <= 0:
+            return []
+        num_completed = len(self.completed_scores)
+        if self._states is None:
+            self._states = [group.reset() for group in self.groups]
+        states = self._states
+
+        actions = [None] * len(self.groups)
+        futures = [None] * len(self.groups)
+        for g, group in enumerate(self.groups):
+            actions[g] = self._act(g, states[g])
+            futures[g] = self._pool.submit(group.step, actions[g])
+
+        for tick in range(num_ticks):
+            for g, group in enumerate(self.groups):
+                next_states, rewards, dones = futures[g].result()
+                self._put((states[g], actions[g], rewards, next_states, dones, self.streams[g]))
+                self.check()
+                self._finish_episodes(g, rewards, dones)
+
+                if self.train:
+                    self.agent.train(group.num_envs, dones.any())
+
+                # The other groups keep stepping while this one runs inference
+                states[g] = group.state
+                if tick + 1 < num_ticks:
+                    actions[g] = self._act(g, states[g])
+                    futures[g] = self._pool.submit(group.step, actions[g])
+            self.ticks += 1
+
+        return self.completed_scores[num_completed:]
+
+    def _finish_episodes(self, g, rewards, dones):
+        self.episode_scores[g] += rewards
+        finished = np.flatnonzero(dones)
+        self.completed_scores.extend(self.episode_scores[g][finished])
+        self.episode_scores[g][finished] = 0.0
+        self.noise[g].reset(finished)
+
+    def close(self):
+        while self._consumer.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._consumer.join()
+        self._pool.shutdown()
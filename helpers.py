@@ -16,6 +16,15 @@ def learn_episode(i_episode, agent, task):
             break
 
 
+def learn_pipelined(num_ticks, collector, log_every=100):
+    """Collect and learn with a PipelinedCollector, printing the scores of finished episodes."""
+    for tick in range(0, num_ticks, log_every):
+        scores = collector.collect(min(log_every, num_ticks - tick))
+        if scores:
+            print("Tick = {:6d}, episodes = {:4d}, mean score = {:7.3f}, best score = {:7.3f}".format(
+                tick + log_every, len(scores), sum(scores) / len(scores), max(scores)))  # [debug]
+
+
 def play_episode(i_episode, agent, task, log_stdout=True):
     state = agent.reset_episode()
     eposide_score = 0.0
@@ -0,0 +1,263 @@
+"""Step kernels for PhysicsSim and Emulator.
+
+These functions are the only implementation of the step. They run as plain Python; when Numba is installed
+`compiled` holds compiled copies of them (compilation is cached on disk next to this module), otherwise
+HAS_JIT is False and `compiled` is None. Without Numba many vehicles are stepped by quadcopter_step_arrays(),
+the same step as NumPy array operations over all of them.
+"""
+import math
+import types
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_JIT = numba is not None
+
+# Layout of the parameter vector built by quadcopter_params()
+P_GRAVITY, P_MASS, P_L_TO_ROTOR, P_PROPELLER_SIZE, P_THRUST = range(5)
+P_LINEAR_DRAG = 5       # 3 values
+P_ANGULAR_DRAG = 8      # 3 values
+P_INV_INERTIA = 11      # 3 values
+P_LOWER_BOUNDS = 14     # 3 values
+P_UPPER_BOUNDS = 17     # 3 values
+NUM_PARAMS = 20
+
+
+def quadcopter_params(sim):
+    """Pack the constants of a PhysicsSim into the parameter vector of the quadcopter kernels."""
+    params = np.empty(NUM_PARAMS)
+    params[P_GRAVITY] = sim.gravity
+    params[P_MASS] = sim.mass
+    params[P_L_TO_ROTOR] = sim.l_to_rotor
+    params[P_PROPELLER_SIZE] = sim.propeller_size
+    params[P_THRUST] = sim.rho * sim.propeller_size**4
+    params[P_LINEAR_DRAG:P_LINEAR_DRAG + 3] = 0.5 * sim.rho * sim.areas * sim.C_d
+    params[P_ANGULAR_DRAG:P_ANGULAR_DRAG + 3] = sim.C_d * 0.5 * sim.rho * sim.areas * sim.dims * sim.dims
+    params[P_INV_INERTIA:P_INV_INERTIA + 3] = 1.0 / sim.moments_of_inertia
+    params[P_LOWER_BOUNDS:P_LOWER_BOUNDS + 3] = sim.lower_bounds
+    params[P_UPPER_BOUNDS:P_UPPER_BOUNDS + 3] = sim.upper_bounds
+    return params
+
+
+def euler_rotation(ii, jj, kk):
+    # earth_to_body_frame() as a flat tuple of floats
+    ci, si = math.cos(ii), math.sin(ii)
+    cj, sj = math.cos(jj), math.sin(jj)
+    ck, sk = math.cos(kk), math.sin(kk)
+    return (ck * cj, ck * sj * si - sk * ci, ck * sj * ci + sk * si,
+            sk * cj, sk * sj * si + ck * ci, sk * sj * ci - ck * si,
+            -sj, cj * si, cj * ci)
+
+
+def rotor_thrust(V, n, D, thrust_factor):
+    if n == 0.0:
+        # Advance ratio is undefined, a stopped rotor gives no thrust
+        return 0.0
+    J = max(0.0, V / (n * D))
+    C_T = max(.12 - .07 * J - .1 * J * J, 0.0)
+    return C_T * thrust_factor * n * n
+
+
+def accelerations(R, vx, vy, vz, wx, wy, wz, rotor_speeds, params, prop_wind_speed, linear_accel,
+                   angular_accels):
+    # Linear and angular accelerations for the earth to body rotation R, a flat 9-tuple. Also writes the
+    # propeller wind speeds and the accelerations. Squares are written as products so that a diverging state
+    # overflows to inf instead of raising OverflowError.
+    r00, r01, r02, r10, r11, r12, r20, r21, r22 = R
+
+    bvx = r00 * vx + r01 * vy + r02 * vz
+    bvy = r10 * vx + r11 * vy + r12 * vz
+    bvz = r20 * vx + r21 * vy + r22 * vz
+
+    # Propeller wind speed and thrust
+    l_to_rotor = params[P_L_TO_ROTOR]
+    D = params[P_PROPELLER_SIZE]
+    prop_wind_speed[0] = bvz + wy * l_to_rotor
+    prop_wind_speed[1] = bvz - wy * l_to_rotor
+    prop_wind_speed[2] = bvz + wx * l_to_rotor
+    prop_wind_speed[3] = bvz - wx * l_to_rotor
+
+    t0 = rotor_thrust(prop_wind_speed[0], rotor_speeds[0], D, params[P_THRUST])
+    t1 = rotor_thrust(prop_wind_speed[1], rotor_speeds[1], D, params[P_THRUST])
+    t2 = rotor_thrust(prop_wind_speed[2], rotor_speeds[2], D, params[P_THRUST])
+    t3 = rotor_thrust(prop_wind_speed[3], rotor_speeds[3], D, params[P_THRUST])
+
+    # Linear forces: body frame thrust and drag rotated back to the earth frame, plus gravity
+    mass = params[P_MASS]
+    fbx = -(params[P_LINEAR_DRAG] * bvx * bvx)
+    fby = -(params[P_LINEAR_DRAG + 1] * bvy * bvy)
+    fbz = (t0 + t1 + t2 + t3) - params[P_LINEAR_DRAG + 2] * bvz * bvz
+    ax = (r00 * fbx + r10 * fby + r20 * fbz) / mass
+    ay = (r01 * fbx + r11 * fby + r21 * fbz) / mass
+    az = (r02 * fbx + r12 * fby + r22 * fbz + mass * params[P_GRAVITY]) / mass
+    linear_accel[0] = ax
+    linear_accel[1] = ay
+    linear_accel[2] = az
+
+    # Moments from thrust and rotational drag
+    alpha_x = ((t3 - t2) * l_to_rotor - params[P_ANGULAR_DRAG] * wx * abs(wx)) * params[P_INV_INERTIA]
+    alpha_y = ((t1 - t0) * l_to_rotor - params[P_ANGULAR_DRAG + 1] * wy * abs(wy)) * params[P_INV_INERTIA + 1]
+    alpha_z = -(params[P_ANGULAR_DRAG + 2] * wz * abs(wz)) * params[P_INV_INERTIA + 2]
+    angular_accels[0] = alpha_x
+    angular_accels[1] = alpha_y
+    angular_accels[2] = alpha_z
+
+    return ax, ay, az, alpha_x, alpha_y, alpha_z
+
+
+def clip_position(position, params):
+    # Clip the first 3 values of `position` to the environment bounds, returns True if they were left
+    out_of_bounds = False
+    for ii in range(3):
+        if position[ii] <= params[P_LOWER_BOUNDS + ii]:
+            position[ii] = params[P_LOWER_BOUNDS + ii]
+            out_of_bounds = True
+        elif position[ii] > params[P_UPPER_BOUNDS + ii]:
+            position[ii] = params[P_UPPER_BOUNDS + ii]
+            out_of_bounds = True
+    return out_of_bounds
+
+
+def quadcopter_step(pose, v, angular_v, linear_accel, angular_accels, prop_wind_speed, rotor_speeds, params, dt):
+    # Semi-explicit step of one vehicle with Euler angles, returns True if it left the bounds
+    dt2 = dt * dt
+    x, y, z = float(pose[0]), float(pose[1]), float(pose[2])
+    phi, theta, psi = float(pose[3]), float(pose[4]), float(pose[5])
+    vx, vy, vz = float(v[0]), float(v[1]), float(v[2])
+    wx, wy, wz = float(angular_v[0]), float(angular_v[1]), float(angular_v[2])
+
+    ax, ay, az, alpha_x, alpha_y, alpha_z = accelerations(
+        euler_rotation(phi, theta, psi), vx, vy, vz, wx, wy, wz, rotor_speeds, params,
+        prop_wind_speed, linear_accel, angular_accels)
+
+    v[0] = vx + ax * dt
+    v[1] = vy + ay * dt
+    v[2] = vz + az * dt
+
+    two_pi = 2 * math.pi
+    pose[3] = (phi + wx * dt + 0.5 * alpha_x * dt2 + two_pi) % two_pi
+    pose[4] = (theta + wy * dt + 0.5 * alpha_y * dt2 + two_pi) % two_pi
+    pose[5] = (psi + wz * dt + 0.5 * alpha_z * dt2 + two_pi) % two_pi
+    angular_v[0] = wx + alpha_x * dt
+    angular_v[1] = wy + alpha_y * dt
+    angular_v[2] = wz + alpha_z * dt
+
+    pose[0] = x + vx * dt + 0.5 * ax * dt2
+    pose[1] = y + vy * dt + 0.5 * ay * dt2
+    pose[2] = z + vz * dt + 0.5 * az * dt2
+    return clip_position(pose, params)
+
+
+def quadcopter_step_batch(pose, v, angular_v, linear_accel, angular_accels, prop_wind_speed, time, done,
+                           rotor_speeds, params, dt, runtime):
+    # BatchedPhysicsSim.next_timestep() over the leading axis of all state arrays
+    for ii in range(pose.shape[0]):
+        if quadcopter_step(pose[ii], v[ii], angular_v[ii], linear_accel[ii], angular_accels[ii],
+                           prop_wind_speed[ii], rotor_speeds[ii], params, dt):
+            done[ii] = True
+        time[ii] += dt
+        if time[ii] > runtime:
+            done[ii] = True
+
+
+def earth_to_body_frames(angles):
+    # euler_rotation() for a batch of (phi, theta, psi) angles, shape (N, 3) -> (N, 3, 3)
+    c = np.cos(angles)
+    s = np.sin(angles)
+    ci, cj, ck = c[:, 0], c[:, 1], c[:, 2]
+    si, sj, sk = s[:, 0], s[:, 1], s[:, 2]
+
+    R = np.empty((angles.shape[0], 3, 3))
+    R[:, 0, 0] = ck * cj
+    R[:, 0, 1] = ck * sj * si - sk * ci
+    R[:, 0, 2] = ck * sj * ci + sk * si
+    R[:, 1, 0] = sk * cj
+    R[:, 1, 1] = sk * sj * si + ck * ci
+    R[:, 1, 2] = sk * sj * ci - ck * si
+    R[:, 2, 0] = -sj
+    R[:, 2, 1] = cj * si
+    R[:, 2, 2] = cj * ci
+    return R
+
+
+def quadcopter_step_arrays(pose, v, angular_v, linear_accel, angular_accels, prop_wind_speed, time, done,
+                           rotor_speeds, params, dt, runtime):
+    # quadcopter_step_batch() as array operations over the leading axis, `params` is the parameter array
+    R = earth_to_body_frames(pose[:, 3:])
+    body_v = np.einsum('nij,nj->ni', R, v)
+
+    # Propeller wind speed and thrust. A stopped rotor gives an infinite or undefined advance ratio, fmax()
+    # maps both to zero thrust like rotor_thrust()
+    l_to_rotor = params[P_L_TO_ROTOR]
+    wx, wy = angular_v[:, 0], angular_v[:, 1]
+    prop_wind_speed[:, 0] = body_v[:, 2] + wy * l_to_rotor
+    prop_wind_speed[:, 1] = body_v[:, 2] - wy * l_to_rotor
+    prop_wind_speed[:, 2] = body_v[:, 2] + wx * l_to_rotor
+    prop_wind_speed[:, 3] = body_v[:, 2] - wx * l_to_rotor
+    n = rotor_speeds
+    with np.errstate(divide='ignore', invalid='ignore'):
+        J = np.fmax(0.0, prop_wind_speed / (n * params[P_PROPELLER_SIZE]))
+        C_T = np.fmax(.12 - .07 * J - .1 * J * J, 0.0)
+    thrusts = C_T * params[P_THRUST] * n * n
+
+    # Linear forces: body frame thrust and drag rotated back to the earth frame, plus gravity
+    mass = params[P_MASS]
+    body_forces = -(params[P_LINEAR_DRAG:P_LINEAR_DRAG + 3] * body_v * body_v)
+    body_forces[:, 2] += thrusts.sum(axis=1)
+    linear_accel[:] = np.einsum('nji,nj->ni', R, body_forces)
+    linear_accel[:, 2] += mass * params[P_GRAVITY]
+    linear_accel /= mass
+
+    # Moments from thrust and rotational drag
+    angular_accels[:] = -(params[P_ANGULAR_DRAG:P_ANGULAR_DRAG + 3] * angular_v * np.abs(angular_v))
+    angular_accels[:, 0] += (thrusts[:, 3] - thrusts[:, 2]) * l_to_rotor
+    angular_accels[:, 1] += (thrusts[:, 1] - thrusts[:, 0]) * l_to_rotor
+    angular_accels *= params[P_INV_INERTIA:P_INV_INERTIA + 3]
+
+    dt2 = dt * dt
+    position = pose[:, :3] + v * dt + 0.5 * linear_accel * dt2
+    v += linear_accel * dt
+    pose[:, 3:] = (pose[:, 3:] + angular_v * dt + 0.5 * angular_accels * dt2 + 2 * np.pi) % (2 * np.pi)
+    angular_v += angular_accels * dt
+
+    lower = params[P_LOWER_BOUNDS:P_LOWER_BOUNDS + 3]
+    upper = params[P_UPPER_BOUNDS:P_UPPER_BOUNDS + 3]
+    below = position <= lower
+    above = position > upper
+    pose[:, :3] = np.where(below, lower, np.where(above, upper, position))
+    done |= (below | above).any(axis=1)
+
+    time += dt
+    done |= time > runtime
+
+
+def emulator_step(pose, v, w, gravity, dt):
+    # Same update as Emulator.next_timestep(), w is clipped in place
+    for ii in range(3):
+        w[ii] = min(max(w[ii], -25.0), 25.0)
+        a = w[ii] - gravity[ii]
+        pose[ii] = pose[ii] + v[ii] * dt + 0.5 * a * dt * dt
+        v[ii] += a * dt
+
+    if pose[2] < 0:
+        pose[2] = 0
+        v[2] = 0
+
+
+def _compile(*funcs):
+    # Compiled copies of the kernels which call each other's compiled copies
+    namespace = dict(globals())
+    for func in funcs:
+        namespace[func.__name__] = numba.njit(cache=True, nogil=True)(
+            types.FunctionType(func.__code__, namespace, func.__name__))
+    return types.SimpleNamespace(**{func.__name__: namespace[func.__name__] for func in funcs})
+
+
+compiled = None
+if HAS_JIT:
+    compiled = _compile(euler_rotation, rotor_thrust, accelerations, clip_position, quadcopter_step,
+                        quadcopter_step_batch, emulator_step)
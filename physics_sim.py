@@ -1,6 +1,24 @@
+import copy
+import math
 import numpy as np
 import csv
 
+import physics_kernels
+
+# Layout of the flat simulator state of PhysicsSim.get_state(), pose, v and angular_v come first so that
+# together they form the observation
+STATE_POSE = slice(0, 6)
+STATE_V = slice(6, 9)
+STATE_ANGULAR_V = slice(9, 12)
+STATE_OBSERVATION = slice(0, 12)
+STATE_LINEAR_ACCEL = slice(12, 15)
+STATE_ANGULAR_ACCELS = slice(15, 18)
+STATE_PROP_WIND_SPEED = slice(18, 22)
+STATE_QUATERNION = slice(22, 26)
+STATE_TIME = 26
+STATE_DONE = 27
+STATE_SIZE = 28
+
 
 def C(x):
     return np.cos(x)
@@ -23,8 +41,61 @@ def body_to_earth_frame(ii, jj, kk):
     return np.transpose(earth_to_body_frame(ii, jj, kk))
 
 
+# earth_to_body_frame() as a flat tuple of floats
+euler_rotation = physics_kernels.euler_rotation
+
+
+def quaternion_rotation(qw, qx, qy, qz):
+    # Same matrix as euler_rotation() for the unit quaternion of the Euler angles, no trigonometry needed
+    return (1 - 2 * (qy * qy + qz * qz), 2 * (qx * qy - qw * qz), 2 * (qx * qz + qw * qy),
+            2 * (qx * qy + qw * qz), 1 - 2 * (qx * qx + qz * qz), 2 * (qy * qz - qw * qx),
+            2 * (qx * qz - qw * qy), 2 * (qy * qz + qw * qx), 1 - 2 * (qx * qx + qy * qy))
+
+
+def euler_to_quaternion(ii, jj, kk):
+    ci, si = math.cos(ii / 2), math.sin(ii / 2)
+    cj, sj = math.cos(jj / 2), math.sin(jj / 2)
+    ck, sk = math.cos(kk / 2), math.sin(kk / 2)
+    return (ci * cj * ck + si * sj * sk,
+            si * cj * ck - ci * sj * sk,
+            ci * sj * ck + si * cj * sk,
+            ci * cj * sk - si * sj * ck)
+
+
+def quaternion_to_euler(qw, qx, qy, qz):
+    # Euler angles wrapped to [0, 2 pi) like the pose of PhysicsSim
+    ii = math.atan2(2 * (qw * qx + qy * qz), 1 - 2 * (qx * qx + qy * qy))
+    jj = math.asin(max(-1.0, min(1.0, 2 * (qw * qy - qz * qx))))
+    kk = math.atan2(2 * (qw * qz + qx * qy), 1 - 2 * (qy * qy + qz * qz))
+    two_pi = 2 * math.pi
+    return (ii + two_pi) % two_pi, (jj + two_pi) % two_pi, (kk + two_pi) % two_pi
+
+
+def quaternion_rates(q, angular_v):
+    # dq/dt = q * (0, w) / 2 for the body rates w
+    qw, qx, qy, qz = q
+    wx, wy, wz = angular_v
+    return 0.5 * np.array([-qx * wx - qy * wy - qz * wz,
+                           qw * wx + qy * wz - qz * wy,
+                           qw * wy - qx * wz + qz * wx,
+                           qw * wz + qx * wy - qy * wx])
+
+
 class PhysicsSim():
-    def __init__(self, init_pose=None, init_velocities=None, init_angle_velocities=None, runtime=5.):
+    def __init__(self, init_pose=None, init_velocities=None, init_angle_velocities=None, runtime=5., use_jit=None,
+                 dt=1 / 50.0, substeps=1, integrator='semi_explicit', attitude='euler'):
+        """Initialize the simulation.
+
+        Params
+        ======
+            use_jit: use the compiled step kernel, by default whenever Numba is available
+            dt: control timestep, the rotor speeds are held constant over it
+            substeps: number of integrator steps per control step
+            integrator: one of INTEGRATORS or a function(sim, y, h, rotor_speeds) returning the next state vector
+            attitude: 'euler' integrates the Euler angles with angular_v as their rates, 'quaternion' integrates
+                a unit quaternion with angular_v as body rates (the same at small angles) and derives the pose
+                angles from it once per control step
+        """
         self.init_pose = init_pose
         self.init_velocities = init_velocities
         self.init_angle_velocities = init_angle_velocities
@@ -33,7 +104,7 @@ class PhysicsSim():
         self.gravity = -9.81  # m/s
         self.rho = 1.2
         self.mass = 0.958  # 300 g
-        self.dt = 1 / 50.0  # Timestep
+        self.dt = dt  # Timestep
         self.C_d = 0.3
         self.l_to_rotor = 0.4
         self.propeller_size = 0.1
@@ -49,102 +120,336 @@ class PhysicsSim():
         self.lower_bounds = np.array([-env_bounds / 2, -env_bounds / 2, 0])
         self.upper_bounds = np.array([env_bounds / 2, env_bounds / 2, env_bounds])
 
+        if attitude not in ('euler', 'quaternion'):
+            raise ValueError("Unknown attitude representation '{}'".format(attitude))
+        self.attitude = attitude
+        self.integrator = INTEGRATORS[integrator] if isinstance(integrator, str) else integrator
+        self.substeps = substeps
+        self._h = self.dt / substeps
+        self._fast_path = self.integrator is semi_explicit_step and attitude == 'euler'
+
+        self.use_jit = physics_kernels.HAS_JIT if use_jit is None else use_jit
+        if self.use_jit and not physics_kernels.HAS_JIT:
+            raise ImportError("Numba is required for the compiled step kernel")
+        self._kernel_params = physics_kernels.quadcopter_params(self)
+        # Indexing a list is much cheaper than indexing an array for the uncompiled kernels
+        self._python_params = self._kernel_params.tolist()
+
+        self._bind_state(np.zeros(self.state_shape))
         self.reset()
 
+    @property
+    def state_shape(self):
+        return (STATE_SIZE,)
+
+    def _bind_state(self, state):
+        # The state arrays are views into one flat buffer and are only ever updated in place
+        self._state = state
+        self.pose = state[..., STATE_POSE]
+        self.v = state[..., STATE_V]
+        self.angular_v = state[..., STATE_ANGULAR_V]
+        self.observation = state[..., STATE_OBSERVATION]
+        self.linear_accel = state[..., STATE_LINEAR_ACCEL]
+        self.angular_accels = state[..., STATE_ANGULAR_ACCELS]
+        self.prop_wind_speed = state[..., STATE_PROP_WIND_SPEED]
+        self.quaternion = state[..., STATE_QUATERNION]
+
     def reset(self):
+        # Copy initial conditions, the step kernel updates the state in place
         self.time = 0.0
-        self.pose = np.array([0.0, 0.0, 10.0, 0.0, 0.0, 0.0]) if self.init_pose is None else self.init_pose
-        self.v = np.array([0.0, 0.0, 0.0]) if self.init_velocities is None else self.init_velocities
-        self.angular_v = np.array([0.0, 0.0, 0.0]) if self.init_angle_velocities is None else self.init_angle_velocities
-        self.linear_accel = np.array([0.0, 0.0, 0.0])
-        self.angular_accels = np.array([0.0, 0.0, 0.0])
-        self.prop_wind_speed = np.array([0., 0., 0., 0.])
+        self.pose[:] = [0.0, 0.0, 10.0, 0.0, 0.0, 0.0] if self.init_pose is None else self.init_pose
+        self.v[:] = [0.0, 0.0, 0.0] if self.init_velocities is None else self.init_velocities
+        self.angular_v[:] = [0.0, 0.0, 0.0] if self.init_angle_velocities is None else self.init_angle_velocities
+        self.linear_accel[:] = 0.0
+        self.angular_accels[:] = 0.0
+        self.prop_wind_speed[:] = 0.0
+        self.quaternion[:] = euler_to_quaternion(*self.pose[3:])
         self.done = False
 
-    def find_body_velocity(self):
-        body_velocity = np.matmul(earth_to_body_frame(*list(self.pose[3:])), self.v)
-        return body_velocity
-
-    def get_linear_drag(self):
-        linear_drag = 0.5 * self.rho * self.find_body_velocity()**2 * self.areas * self.C_d
-        return linear_drag
-
-    def get_linear_forces(self, thrusts):
-        # Gravity
-        gravity_force = self.mass * self.gravity * np.array([0, 0, 1])
-        # Thrust
-        thrust_body_force = np.array([0, 0, sum(thrusts)])
-        # Drag
-        drag_body_force = -self.get_linear_drag()
-        body_forces = thrust_body_force + drag_body_force
-
-        linear_forces = np.matmul(body_to_earth_frame(*list(self.pose[3:])), body_forces)
-        linear_forces += gravity_force
-        return linear_forces
-
-    def get_moments(self, thrusts):
-        thrust_moment = np.array([(thrusts[3] - thrusts[2]) * self.l_to_rotor,
-                            (thrusts[1] - thrusts[0]) * self.l_to_rotor,
-                            0])# (thrusts[2] + thrusts[3] - thrusts[0] - thrusts[1]) * self.T_q])  # Moment from thrust
-
-        drag_moment =  self.C_d * 0.5 * self.rho * self.angular_v * np.absolute(self.angular_v) * self.areas * self.dims * self.dims
-        moments = thrust_moment - drag_moment # + motor_inertia_moment
-        return moments
-
-    def calc_prop_wind_speed(self):
-        body_velocity = self.find_body_velocity()
-        phi_dot, theta_dot = self.angular_v[0], self.angular_v[1]
-        s_0 = np.array([0., 0., theta_dot * self.l_to_rotor])
-        s_1 = -s_0
-        s_2 = np.array([0., 0., phi_dot * self.l_to_rotor])
-        s_3 = -s_2
-        speeds = [s_0, s_1, s_2, s_3]
-        for num in range(4):
-            perpendicular_speed = speeds[num] + body_velocity
-            self.prop_wind_speed[num] = perpendicular_speed[2]
-
-    def get_propeler_thrust(self, rotor_speeds):
-        '''calculates net thrust (thrust - drag) based on velocity
-        of propeller and incoming power'''
-        thrusts = []
-        for prop_number in range(4):
-            V = self.prop_wind_speed[prop_number]
-            D = self.propeller_size
-            n = rotor_speeds[prop_number]
-            J = V / (n * D)
-            # From http://m-selig.ae.illinois.edu/pubs/BrandtSelig-2011-AIAA-2011-1255-LRN-Propellers.pdf
-            C_T = max(.12 - .07*max(0, J)-.1*max(0, J)**2, 0)
-            thrusts.append(C_T * self.rho * n**2 * D**4)
-        return thrusts
+    def get_state(self, out=None):
+        """Full simulator state packed into one flat array of STATE_SIZE, written to `out` if given."""
+        self._state[STATE_TIME] = self.time
+        self._state[STATE_DONE] = self.done
+        if out is None:
+            return self._state.copy()
+        out[:] = self._state
+        return out
 
-    def next_timestep(self, rotor_speeds):
-        self.calc_prop_wind_speed()
-        thrusts = self.get_propeler_thrust(rotor_speeds)
-        self.linear_accel = self.get_linear_forces(thrusts) / self.mass
+    def set_state(self, state):
+        """Restore a state returned by get_state()."""
+        self._state[:] = state
+        self.time = float(self._state[STATE_TIME])
+        self.done = bool(self._state[STATE_DONE])
 
-        position = self.pose[:3] + self.v * self.dt + 0.5 * self.linear_accel * self.dt**2
-        self.v += self.linear_accel * self.dt
+    def clone(self):
+        """Independent copy of the simulator in its current state."""
+        other = copy.copy(self)
+        other._bind_state(self.get_state())
+        return other
 
-        moments = self.get_moments(thrusts)
+    def rollout(self, actions):
+        """Simulate a whole sequence of rotor speeds in one call, see rollout()."""
+        return rollout(self, actions)
 
-        self.angular_accels = moments / self.moments_of_inertia
-        angles = self.pose[3:] + self.angular_v * self.dt + 0.5 * self.angular_accels * self.dt**2
-        angles = (angles + 2 * np.pi) % (2 * np.pi)
-        self.angular_v = self.angular_v + self.angular_accels * self.dt
+    def trajectory(self, states):
+        """Named views into an array of flat states."""
+        return {
+            'time': states[..., STATE_TIME],
+            'pose': states[..., STATE_POSE],
+            'v': states[..., STATE_V],
+            'angular_v': states[..., STATE_ANGULAR_V],
+            'linear_accel': states[..., STATE_LINEAR_ACCEL],
+            'angular_accels': states[..., STATE_ANGULAR_ACCELS],
+            'done': states[..., STATE_DONE] != 0,
+        }
 
-        new_positions = []
-        for ii in range(3):
-            if position[ii] <= self.lower_bounds[ii]:
-                new_positions.append(self.lower_bounds[ii])
-                self.done = True
-            elif position[ii] > self.upper_bounds[ii]:
-                new_positions.append(self.upper_bounds[ii])
-                self.done = True
+    def next_timestep(self, rotor_speeds):
+        """Advance the simulation by one control step dt made of `substeps` integrator steps.
+
+        The default semi-explicit integrator with Euler angles runs the step kernel of physics_kernels,
+        compiled with use_jit and as plain Python otherwise. The other integrators step the state vector
+        with the accelerations of the same kernels.
+        """
+        if self._fast_path:
+            if self.use_jit:
+                step, params = physics_kernels.compiled.quadcopter_step, self._kernel_params
+                rotor_speeds = np.asarray(rotor_speeds, dtype=float)
             else:
-                new_positions.append(position[ii])
+                step, params = physics_kernels.quadcopter_step, self._python_params
+                rotor_speeds = [float(n) for n in rotor_speeds]
+            for _ in range(self.substeps):
+                if step(self.pose, self.v, self.angular_v, self.linear_accel, self.angular_accels,
+                        self.prop_wind_speed, rotor_speeds, params, self._h):
+                    self.done = True
+        else:
+            self._integrate(rotor_speeds)
 
-        self.pose = np.array(new_positions + list(angles))
         self.time += self.dt
         if self.time > self.runtime:
             self.done = True
-        return self.done
\ No newline at end of file
+        return self.done
+
+    def accelerations(self, R, vx, vy, vz, wx, wy, wz, rotor_speeds):
+        """Linear and angular accelerations for the earth to body rotation R given as a flat 9-tuple.
+
+        Also stores the propeller wind speeds and the accelerations on the simulator.
+        """
+        return physics_kernels.accelerations(
+            R, vx, vy, vz, wx, wy, wz, rotor_speeds, self._python_params,
+            self.prop_wind_speed, self.linear_accel, self.angular_accels)
+
+    # Generic integration over the state vector y = [position, attitude, v, angular_v], where the attitude
+    # is either the Euler angles or the quaternion of the simulator
+
+    @property
+    def num_coordinates(self):
+        return 7 if self.attitude == 'quaternion' else 6
+
+    def coordinate_rates(self, y):
+        """Time derivative of position and attitude for the velocities in the state vector y."""
+        n = self.num_coordinates
+        rates = np.empty(n)
+        rates[0:3] = y[n:n + 3]
+        if self.attitude == 'quaternion':
+            rates[3:7] = quaternion_rates(y[3:7], y[n + 3:n + 6])
+        else:
+            rates[3:6] = y[n + 3:n + 6]
+        return rates
+
+    def derivative(self, y, rotor_speeds):
+        """Time derivative of the state vector y."""
+        n = self.num_coordinates
+        if self.attitude == 'quaternion':
+            R = quaternion_rotation(*y[3:7])
+        else:
+            R = euler_rotation(*y[3:6])
+        dy = np.empty_like(y)
+        dy[0:n] = self.coordinate_rates(y)
+        dy[n:n + 6] = self.accelerations(R, *y[n:n + 6], rotor_speeds)
+        return dy
+
+    def _integrate(self, rotor_speeds):
+        if self.attitude == 'quaternion':
+            y = np.concatenate((self.pose[:3], self.quaternion, self.v, self.angular_v))
+        else:
+            y = np.concatenate((self.pose, self.v, self.angular_v))
+
+        for _ in range(self.substeps):
+            y = self.integrator(self, y, self._h, rotor_speeds)
+            if physics_kernels.clip_position(y, self._python_params):
+                self.done = True
+            if self.attitude == 'quaternion':
+                y[3:7] /= math.sqrt(y[3] * y[3] + y[4] * y[4] + y[5] * y[5] + y[6] * y[6])
+            else:
+                y[3:6] = (y[3:6] + 2 * np.pi) % (2 * np.pi)
+
+        n = self.num_coordinates
+        self.pose[:3] = y[0:3]
+        if self.attitude == 'quaternion':
+            self.quaternion[:] = y[3:7]
+            self.pose[3:] = quaternion_to_euler(*self.quaternion)
+        else:
+            self.pose[3:] = y[3:6]
+        self.v[:] = y[n:n + 3]
+        self.angular_v[:] = y[n + 3:n + 6]
+
+
+def euler_step(sim, y, h, rotor_speeds):
+    """Explicit Euler."""
+    return y + h * sim.derivative(y, rotor_speeds)
+
+
+def semi_explicit_step(sim, y, h, rotor_speeds):
+    """Constant acceleration over the step: x += v h + a h^2 / 2, v += a h (the original PhysicsSim update)."""
+    n = sim.num_coordinates
+    accelerations = sim.derivative(y, rotor_speeds)[n:]
+    y = y.copy()
+    mid = y.copy()
+    mid[n:] += 0.5 * h * accelerations
+    y[0:n] += h * sim.coordinate_rates(mid)
+    y[n:] += h * accelerations
+    return y
+
+
+def semi_implicit_step(sim, y, h, rotor_speeds):
+    """Semi-implicit (symplectic) Euler: update the velocities first, then move with the new velocities."""
+    n = sim.num_coordinates
+    y = y.copy()
+    y[n:] += h * sim.derivative(y, rotor_speeds)[n:]
+    y[0:n] += h * sim.coordinate_rates(y)
+    return y
+
+
+def rk4_step(sim, y, h, rotor_speeds):
+    """Classic fourth order Runge-Kutta."""
+    k1 = sim.derivative(y, rotor_speeds)
+    k2 = sim.derivative(y + 0.5 * h * k1, rotor_speeds)
+    k3 = sim.derivative(y + 0.5 * h * k2, rotor_speeds)
+    k4 = sim.derivative(y + h * k3, rotor_speeds)
+    return y + h / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+INTEGRATORS = {
+    'euler': euler_step,
+    'semi_explicit': semi_explicit_step,
+    'semi_implicit': semi_implicit_step,
+    'rk4': rk4_step,
+}
+
+
+def rollout(sim, actions):
+    """Simulate whole action sequences on a simulator with get_state()/set_state() and trajectory().
+
+    `actions` of shape (T, num_actions) continues from the current state of the simulator. Shape
+    (N, T, num_actions) runs N sequences which all branch from the current state, which is restored
+    afterwards. The result maps 'time', 'pose', 'v', 'angular_v', 'linear_accel', 'angular_accels'
+    and 'done' to arrays of shape (T, ...) or (N, T, ...), all views into one preallocated array of
+    flat states under 'states'. Steps after the episode ended repeat its final state.
+    """
+    # Copy, the emulator clips its actions in place
+    actions = np.array(actions, dtype=float)
+    states = np.empty(actions.shape[:-1] + sim.get_state().shape)
+
+    def run(actions, states):
+        step = sim.next_timestep
+        get_state = sim.get_state
+        for t, action in enumerate(actions):
+            if sim.done:
+                states[t:] = get_state()
+                break
+            step(action)
+            get_state(states[t])
+
+    if actions.ndim == 3:
+        start = sim.get_state()
+        for branch, branch_states in zip(actions, states):
+            sim.set_state(start)
+            run(branch, branch_states)
+        sim.set_state(start)
+    else:
+        run(actions, states)
+
+    result = sim.trajectory(states)
+    result['states'] = states
+    return result
+
+
+class BatchedPhysicsSim(PhysicsSim):
+    """Steps `num_envs` quadcopters at once.
+
+    Same physics as PhysicsSim, but pose, v, angular_v, accelerations, time and done
+    carry a leading environment axis, and rotor speeds are given as a (num_envs, 4) array.
+    Environments which are done keep being simulated until they are reset. Only the default integration, one
+    semi-explicit step per control step `dt` with Euler angles, is supported. With use_jit the vehicles are
+    stepped by the compiled kernel, otherwise by the NumPy array operations of
+    physics_kernels.quadcopter_step_arrays().
+    """
+    def __init__(self, num_envs, init_pose=None, init_velocities=None, init_angle_velocities=None, runtime=5.,
+                 use_jit=None, dt=1 / 50.0):
+        self.num_envs = num_envs
+        super().__init__(init_pose, init_velocities, init_angle_velocities, runtime, use_jit, dt)
+
+    def _initial(self, value, default):
+        value = default if value is None else value
+        return np.broadcast_to(np.asarray(value, dtype=float), (self.num_envs, len(default)))
+
+    @property
+    def state_shape(self):
+        return (self.num_envs, STATE_SIZE)
+
+    def _bind_state(self, state):
+        super()._bind_state(state)
+        self.time = state[:, STATE_TIME]
+        self.done = state[:, STATE_DONE] != 0
+
+    def get_state(self, out=None):
+        """States of all environments as a (num_envs, STATE_SIZE) array, written to `out` if given."""
+        self._state[:, STATE_DONE] = self.done
+        if out is None:
+            return self._state.copy()
+        out[:] = self._state
+        return out
+
+    def set_state(self, state):
+        self._state[:] = state
+        self.done[:] = self._state[:, STATE_DONE] != 0
+
+    def rollout(self, actions):
+        """Simulate (T, num_envs, 4) rotor speeds from the current states in one call.
+
+        Returns the same trajectory arrays as PhysicsSim.rollout() with shape (T, num_envs, ...), environments
+        which are done keep being simulated.
+        """
+        actions = np.asarray(actions, dtype=float)
+        states = np.empty((len(actions),) + self.state_shape)
+        for t, action in enumerate(actions):
+            self.next_timestep(action)
+            self.get_state(states[t])
+        result = self.trajectory(states)
+        result['states'] = states
+        return result
+
+    def reset(self, mask=None):
+        """Reset all environments, or only those selected by the boolean `mask`."""
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+
+        self.time[mask] = 0.0
+        self.pose[mask] = self._initial(self.init_pose, [0.0, 0.0, 10.0, 0.0, 0.0, 0.0])[mask]
+        self.v[mask] = self._initial(self.init_velocities, [0.0, 0.0, 0.0])[mask]
+        self.angular_v[mask] = self._initial(self.init_angle_velocities, [0.0, 0.0, 0.0])[mask]
+        self.linear_accel[mask] = 0.0
+        self.angular_accels[mask] = 0.0
+        self.prop_wind_speed[mask] = 0.0
+        self.done[mask] = False
+
+    def next_timestep(self, rotor_speeds):
+        rotor_speeds = np.broadcast_to(np.asarray(rotor_speeds, dtype=float), (self.num_envs, 4))
+        if self.use_jit:
+            step = physics_kernels.compiled.quadcopter_step_batch
+        else:
+            step = physics_kernels.quadcopter_step_arrays
+        step(self.pose, self.v, self.angular_v, self.linear_accel, self.angular_accels, self.prop_wind_speed,
+             self.time, self.done, np.ascontiguousarray(rotor_speeds), self._kernel_params, self.dt,
+             self.runtime)
+        return self.done
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from agents.noise import VectorOUNoise2
+
+# No request left waiting after a batch
+_EMPTY = object()
+
+
+class PolicyServer:
+    """Serves the actions of many environments with batched policy evaluations on a worker thread.
+
+    Requests from any number of threads wait in a queue; the worker takes the first one, then any others
+    arriving within `max_latency` seconds, up to `max_batch` states or one per environment, and evaluates them
+    with one call of `policy`, a function of a (N, num_states) batch such as DeepDPGAgent.policy or a
+    NumpyActor. The exploration noise of each environment is the OUNoise2 process of DeepDPGAgent.act(),
+    seeded with `seed` + env when given, the actions are clipped to [action_low, action_high].
+
+    Params
+    ======
+        policy: function of a batch of states returning a batch of actions
+        num_envs: number of environments, identified by their index in requests
+        noise: add exploration noise, otherwise serve the plain policy
+    """
+    def __init__(self, policy, num_envs, num_states, num_actions, action_low, action_high, max_batch=64,
+                 max_latency=0.001, noise=True, theta=0.15, sigma=0.2, seed=None):
+        self.policy = policy
+        self.num_envs = num_envs
+        self.action_low = action_low
+        self.action_high = action_high
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self.noise = None
+        if noise:
+            self.noise = VectorOUNoise2(num_envs, num_actions, theta=theta, sigma=sigma, seeds=seed)
+
+        # Served states and policy evaluations
+        self.requests = 0
+        self.batches = 0
+
+        self._states = np.empty((max_batch, num_states), dtype=np.float32)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def mean_batch_size(self):
+        return self.requests / self.batches if self.batches else 0.0
+
+    def act(self, env, state):
+        """Action of environment `env` in `state`, blocks until served."""
+        return self.submit([env], np.expand_dims(state, axis=0)).result()[0]
+
+    def act_batch(self, envs, states):
+        """Actions of the environments `envs` in the (N, num_states) `states`, blocks until served."""
+        return self.submit(envs, states).result()
+
+    def submit(self, envs, states):
+        """Queue the states of environments `envs`, returns a Future of their (N, num_actions) actions.
+
+        Up to max_batch environments go in one request.
+        """
+        if len(envs) > self.max_batch:
+            raise ValueError("PolicyServer requests hold at most max_batch = {} states".format(self.max_batch))
+        future = Future()
+        self._queue.put((np.asarray(envs), states, future))
+        return future
+
+    def reset(self, env):
+        """Restart the exploration noise of environment `env`, at the start of its episode."""
+        if self.noise is not None:
+            self.noise.reset([env])
+
+    def _next_batch(self, first):
+        batch = [first]
+        size = len(first[0])
+        deadline = time.perf_counter() + self.max_latency
+        # No need to wait once every environment is in
+        while size < min(self.max_batch, self.num_envs):
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return batch, _EMPTY
+            if request is None or size + len(request[0]) > self.max_batch:
+                return batch, request
+            batch.append(request)
+            size += len(request[0])
+        return batch, _EMPTY
+
+    def _serve(self, batch):
+        sizes = [len(envs) for envs, _, _ in batch]
+        size = sum(sizes)
+        states = self._states[:size]
+        i = 0
+        for envs, request_states, _ in batch:
+            states[i:i + len(envs)] = request_states
+            i += len(envs)
+
+        actions = np.array(self.policy(states), dtype=np.float64)
+        if self.noise is not None:
+            actions += self.noise.sample(np.concatenate([envs for envs, _, _ in batch]))
+        np.clip(actions, self.action_low, self.action_high, out=actions)
+
+        i = 0
+        for (_, _, future), n in zip(batch, sizes):
+            future.set_result(actions[i:i + n])
+            i += n
+        self.requests += size
+        self.batches += 1
+
+    def _run(self):
+        # The request which did not fit in the previous batch, None when closing
+        request = self._queue.get()
+        while request is not None:
+            batch, request = self._next_batch(request)
+            try:
+                self._serve(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+            if request is _EMPTY:
+                request = self._queue.get()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -1,5 +1,7 @@
 from .takeoff import Takeoff
 from .hover import Hover
+from .vector_task import VectorTask
+from .subproc_vector_task import SubprocVectorTask
 
 from .emulator.takeoff import Takeoff as EmulatorTakeoff
 from .emulator.hover import Hover as EmulatorHover
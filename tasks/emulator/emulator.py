@@ -1,52 +1,103 @@
 from geometry_msgs.msg import Vector3, Point, Quaternion, Pose, Twist, Wrench
 
+import copy
 import numpy as np
 
+import physics_kernels
+from physics_sim import rollout
+
+# Layout of the flat emulator state of Emulator.get_state(), the first 12 values match PhysicsSim
+STATE_POSE = slice(0, 6)
+STATE_V = slice(6, 9)
+STATE_ANGULAR_V = slice(9, 12)
+STATE_OBSERVATION = slice(0, 12)
+STATE_LINEAR_ACCEL = slice(12, 15)
+STATE_ANGULAR_ACCELS = slice(15, 18)
+STATE_PROP_WIND_SPEED = slice(18, 22)
+STATE_TIME = 22
+STATE_DONE = 23
+STATE_SIZE = 24
 
-def limit(t, mn, mx):
-    if t < mn:
-        return mn
-    elif t > mx:
-        return mx
-    else:
-        return t
 
 class Emulator:
-    def __init__(self, init_pose=None, init_v=None, runtime=10.):
+    def __init__(self, init_pose=None, init_v=None, runtime=10., use_jit=None):
         self.init_pose = init_pose
         self.init_velocities = init_v
         self.runtime = runtime
+        self.use_jit = physics_kernels.HAS_JIT if use_jit is None else use_jit
+        if self.use_jit and not physics_kernels.HAS_JIT:
+            raise ImportError("Numba is required for the compiled step kernel")
+        self._bind_state(np.zeros(STATE_SIZE))
         self.reset()
 
+    def _bind_state(self, state):
+        # The state arrays are views into one flat buffer and are only ever updated in place
+        self._state = state
+        self.pose = state[STATE_POSE]
+        self.v = state[STATE_V]
+        self.angular_v = state[STATE_ANGULAR_V]
+        self.observation = state[STATE_OBSERVATION]
+        self.linear_accel = state[STATE_LINEAR_ACCEL]
+        self.angular_accels = state[STATE_ANGULAR_ACCELS]
+        self.prop_wind_speed = state[STATE_PROP_WIND_SPEED]
+
     def reset(self):
-        self.pose = np.array([0.0, 0.0, 10.0, 0.0, 0.0, 0.0]) if self.init_pose is None else np.copy(self.init_pose)
-        self.v = np.array([0.0, 0.0, 0.0])
-        self.angular_v = np.array([0.0, 0.0, 0.0])
+        self.pose[:] = [0.0, 0.0, 10.0, 0.0, 0.0, 0.0] if self.init_pose is None else self.init_pose
+        self.v[:] = 0.0
+        self.angular_v[:] = 0.0
 
-        self.linear_accel = np.array([0.0, 0.0, 0.0])
-        self.angular_accels = np.array([0.0, 0.0, 0.0])
-        self.prop_wind_speed = np.array([0., 0., 0., 0.])
+        self.linear_accel[:] = 0.0
+        self.angular_accels[:] = 0.0
+        self.prop_wind_speed[:] = 0.0
         self.done = False
 
         self.time = 0.0
         self.time_delta = 0.1
         self.gravity = np.array([0.0, 0.0, 9.8])
 
-    def next_timestep(self, w):
-        w[0] = limit(w[0], -25.0, 25.0)
-        w[1] = limit(w[1], -25.0, 25.0)
-        w[2] = limit(w[2], -25.0, 25.0)
+    def get_state(self, out=None):
+        """Full emulator state packed into one flat array of STATE_SIZE, written to `out` if given."""
+        self._state[STATE_TIME] = self.time
+        self._state[STATE_DONE] = self.done
+        if out is None:
+            return self._state.copy()
+        out[:] = self._state
+        return out
+
+    def set_state(self, state):
+        """Restore a state returned by get_state()."""
+        self._state[:] = state
+        self.time = float(self._state[STATE_TIME])
+        self.done = bool(self._state[STATE_DONE])
 
-        self.pose[0:3] = self.pose[0:3] + self.v * self.time_delta + 0.5 * (w - self.gravity) * self.time_delta * self.time_delta
-        self.v += (w - self.gravity) * self.time_delta
+    def clone(self):
+        """Independent copy of the emulator in its current state."""
+        other = copy.copy(self)
+        other._bind_state(self.get_state())
+        return other
 
-        # At the ground?
-        if self.pose[2] < 0:
-            self.pose[2] = 0
-            self.v[2] = 0
+    def rollout(self, actions):
+        """Simulate a whole sequence of (T, 3) or (N, T, 3) actions in one call, see physics_sim.rollout()."""
+        return rollout(self, actions)
+
+    def trajectory(self, states):
+        """Named views into an array of flat states."""
+        return {
+            'time': states[..., STATE_TIME],
+            'pose': states[..., STATE_POSE],
+            'v': states[..., STATE_V],
+            'angular_v': states[..., STATE_ANGULAR_V],
+            'linear_accel': states[..., STATE_LINEAR_ACCEL],
+            'angular_accels': states[..., STATE_ANGULAR_ACCELS],
+            'done': states[..., STATE_DONE] != 0,
+        }
+
+    def next_timestep(self, w):
+        """Advance by one step of time_delta, `w` is the acceleration command, clipped in place."""
+        step = physics_kernels.compiled.emulator_step if self.use_jit else physics_kernels.emulator_step
+        step(self.pose, self.v, np.asarray(w, dtype=float), self.gravity, self.time_delta)
 
         self.time += self.time_delta
 
         if self.time > self.runtime:
             self.done = True
-
@@ -1,4 +1,3 @@
-import math
 import numpy as np
 from .task import Task
 
@@ -29,26 +28,26 @@ class Hover(Task):
         reward = 20.0
 
         def apply_lower_threshold(x, threshold):
-            return max(0.0, x - threshold)
+            return np.maximum(0.0, x - threshold)
 
         def apply_higher_threshold(x, threshold):
-            return max(0.0, threshold - x)
+            return np.maximum(0.0, threshold - x)
 
         # Compute reward for reaching target height
-        target_z_distance = abs(self.target_z - self.position[2])
+        target_z_distance = abs(self.target_z - self.position[..., 2])
         height_penalty = target_z_distance
 
         # Penalize for shifting in horizontal plane
-        xy_shift_penalty = math.sqrt(self.position[0]**2 + self.position[1]**2)
+        xy_shift_penalty = np.sqrt(self.position[..., 0]**2 + self.position[..., 1]**2)
 
         # Penalize for going to far away
         too_far_penalty = apply_lower_threshold(target_z_distance, 120) ** 2
 
         # Penalise for twist angles
-        twist_penalty = apply_lower_threshold((1. - np.cos(self.orientation)).sum(), 0.1)
+        twist_penalty = apply_lower_threshold((1. - np.cos(self.orientation)).sum(axis=-1), 0.1)
 
         # Penalise for rotating
-        rotation_penalty = apply_lower_threshold(np.abs(self.sim.angular_v).sum(), 0.5)
+        rotation_penalty = apply_lower_threshold(np.abs(self.sim.angular_v).sum(axis=-1), 0.5)
 
         # Orientation reward
         reward -= height_penalty * 0.3 + xy_shift_penalty * 0.01 + too_far_penalty * 0.1 + twist_penalty * 3.0 + rotation_penalty * 0.5
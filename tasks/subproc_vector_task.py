@@ -0,0 +1,165 @@
+import multiprocessing as mp
+import traceback
+
+import numpy as np
+
+from .vector_task import VectorTask
+
+# Commands of the workers
+STEP = 1
+RESET = 2
+CLOSE = 3
+
+
+class SharedBuffers:
+    """NumPy views of the shared memory blocks between SubprocVectorTask and its workers."""
+    def __init__(self, raw, num_envs, num_states, num_actions):
+        self.raw = raw
+        self.command = np.frombuffer(raw['command'], dtype=np.int32)
+        self.actions = np.frombuffer(raw['actions']).reshape(num_envs, num_actions)
+        self.reset_mask = np.frombuffer(raw['reset_mask'], dtype=np.uint8)
+        self.next_states = np.frombuffer(raw['next_states']).reshape(num_envs, num_states)
+        self.states = np.frombuffer(raw['states']).reshape(num_envs, num_states)
+        self.rewards = np.frombuffer(raw['rewards'])
+        self.dones = np.frombuffer(raw['dones'], dtype=np.uint8)
+
+    @staticmethod
+    def allocate(num_envs, num_states, num_actions):
+        return {
+            'command': mp.RawArray('i', 1),
+            'actions': mp.RawArray('d', num_envs * num_actions),
+            'reset_mask': mp.RawArray('B', num_envs),
+            'next_states': mp.RawArray('d', num_envs * num_states),
+            'states': mp.RawArray('d', num_envs * num_states),
+            'rewards': mp.RawArray('d', num_envs),
+            'dones': mp.RawArray('B', num_envs),
+        }
+
+
+def worker(task_factory, envs, seed, raw, shape, start, finished, errors):
+    """Steps the environments `envs` (a slice) of a SubprocVectorTask on commands from the parent.
+
+    An exception ends the worker after putting its traceback on `errors`.
+    """
+    try:
+        run_worker(task_factory, envs, seed, raw, shape, start, finished)
+    except Exception:
+        errors.put('Worker for environments {}-{}:\n{}'.format(envs.start, envs.stop - 1, traceback.format_exc()))
+
+
+def run_worker(task_factory, envs, seed, raw, shape, start, finished):
+    np.random.seed(seed)
+    buffers = SharedBuffers(raw, *shape)
+    vector = VectorTask(task_factory(), envs.stop - envs.start)
+    buffers.states[envs] = vector.state
+
+    while True:
+        start.acquire()
+        command = buffers.command[0]
+        if command == STEP:
+            next_states, rewards, dones = vector.step(buffers.actions[envs])
+            buffers.next_states[envs] = next_states
+            buffers.rewards[envs] = rewards
+            buffers.dones[envs] = dones
+            buffers.states[envs] = vector.state
+        elif command == RESET:
+            mask = buffers.reset_mask[envs].astype(bool)
+            if mask.any():
+                buffers.states[envs] = vector.reset(mask)
+        finished.release()
+        if command == CLOSE:
+            break
+
+
+class SubprocVectorTask:
+    """VectorTask split over worker processes, exchanging all data through shared memory.
+
+    `task_factory` is a picklable callable creating the task, e.g. the task class or a functools.partial of it.
+    Every worker runs a VectorTask over its share of the `num_envs` environments with its own random seed;
+    all workers step in lockstep. The interface is the one of VectorTask. If a worker fails or dies, the
+    call waiting for it raises a RuntimeError with the worker's traceback and the other workers are stopped.
+    """
+    def __init__(self, task_factory, num_envs, num_workers=None, seed=None):
+        task = task_factory()
+        self.task_name = task.task_name
+        self.action_low = task.action_low
+        self.action_high = task.action_high
+        self.num_envs = num_envs
+        self._num_states = task.num_states
+        self._num_actions = task.num_actions
+
+        num_workers = min(num_workers or mp.cpu_count(), num_envs)
+        seed = np.random.randint(2**31 - num_workers) if seed is None else seed
+
+        shape = (num_envs, self._num_states, self._num_actions)
+        raw = SharedBuffers.allocate(*shape)
+        self._buffers = SharedBuffers(raw, *shape)
+
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self._starts = [mp.Semaphore(0) for _ in range(num_workers)]
+        self._finished = mp.Semaphore(0)
+        self._errors = mp.SimpleQueue()
+        self._workers = [
+            mp.Process(target=worker,
+                       args=(task_factory, slice(bounds[i], bounds[i + 1]), seed + i, raw, shape,
+                             self._starts[i], self._finished, self._errors),
+                       daemon=True)
+            for i in range(num_workers)]
+        for process in self._workers:
+            process.start()
+        self._closed = False
+
+    @property
+    def num_states(self):
+        return self._num_states
+
+    @property
+    def num_actions(self):
+        return self._num_actions
+
+    @property
+    def state(self):
+        """Current states of all environments, after the automatic reset of finished ones."""
+        return self._buffers.states.copy()
+
+    def _run(self, command):
+        self._buffers.command[0] = command
+        for start in self._starts:
+            start.release()
+        for _ in self._starts:
+            while not self._finished.acquire(timeout=0.1):
+                if not all(process.is_alive() for process in self._workers):
+                    self._fail()
+
+    def _fail(self):
+        messages = []
+        while not self._errors.empty():
+            messages.append(self._errors.get())
+        for i, process in enumerate(self._workers):
+            if not process.is_alive() and process.exitcode != 0:
+                messages.append('Worker {} exited with code {}'.format(i, process.exitcode))
+        for process in self._workers:
+            process.terminate()
+            process.join()
+        self._closed = True
+        raise RuntimeError('SubprocVectorTask worker failed\n' + '\n'.join(messages))
+
+    def reset(self, mask=None):
+        """Reset all environments, or those selected by the boolean `mask`, and return the states of all."""
+        self._buffers.reset_mask[:] = True if mask is None else mask
+        self._run(RESET)
+        return self.state
+
+    def step(self, actions):
+        """Step all environments, see VectorTask.step()."""
+        self._buffers.actions[:] = actions
+        self._run(STEP)
+        return self._buffers.next_states.copy(), self._buffers.rewards.copy(), self._buffers.dones.astype(bool)
+
+    def close(self):
+        if self._closed:
+            return
+        self._run(CLOSE)
+        for process in self._workers:
+            process.join()
+        self._closed = True
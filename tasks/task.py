@@ -39,7 +39,7 @@ class Task():
 
     def get_reward(self):
         """Uses current pose of sim to return reward."""
-        reward = 1.-.3*(abs(self.sim.pose[:3] - self.target_pos)).sum()
+        reward = 1.-.3*(abs(self.sim.pose[..., :3] - self.target_pos)).sum(axis=-1)
         return reward
 
     @property
@@ -50,39 +50,58 @@ class Task():
     def num_actions(self):
         return self.action_size
 
-    def step(self, action):
-        """Uses action to obtain next state, reward, done."""
+    def step(self, action, copy=True):
+        """Uses action to obtain next state, reward, done.
+
+        The next state is a copy of the frame buffer, or with `copy=False` a view which is only valid until
+        the next step.
+        """
         reward = 0
-        state_all = []
+        frames = self.frame_buffer()
 
         if self.simplified:
             action = self.simplified_action_to_full(action)
 
-        for _ in range(self.action_repeat):
+        if self.action_repeat == 1:
             self.sim.next_timestep(action) # update the sim pose and velocities
             reward += self.get_reward()
-            state_all.append(self.state)
-            if self.sim.done:
-                for __ in range(_+1, self.action_repeat):
-                    state_all.append(self.state)
-                break
-        next_state = np.concatenate(state_all)
-        return next_state, reward, self.done
+            next_state = self.state
+        else:
+            for _ in range(self.action_repeat):
+                self.sim.next_timestep(action) # update the sim pose and velocities
+                reward += self.get_reward()
+                frames[_] = self.state
+                if self.sim.done:
+                    frames[_+1:] = frames[_]
+                    break
+            next_state = frames.reshape(-1)
+        return next_state.copy() if copy else next_state, reward, self.done
+
+    def frame_buffer(self):
+        """Preallocated (action_repeat, observation size) stack of the states of one step."""
+        shape = (self.action_repeat, len(self.state))
+        if getattr(self, '_frames', None) is None or self._frames.shape != shape:
+            self._frames = np.empty(shape)
+        return self._frames
 
     def simplified_action_to_full(self, action):
         return np.array([action[0]] * 4)
 
+    # State, reward and termination also evaluate element-wise when the simulator is a BatchedPhysicsSim,
+    # see VectorTask
+
     @property
     def state(self):
-        return np.append(self.sim.pose, np.append(self.sim.v, self.sim.angular_v))
+        # View into the simulator state: pose, v and angular_v
+        return self.sim.observation
 
     @property
     def position(self):
-        return self.sim.pose[0:3]
+        return self.sim.pose[..., 0:3]
 
     @property
     def orientation(self):
-        return self.sim.pose[3:6]
+        return self.sim.pose[..., 3:6]
 
     @property
     def timeout(self):
@@ -90,11 +109,11 @@ class Task():
 
     @property
     def out_of_bounds(self):
-        return self.sim.done and self.sim.time < self.sim.runtime
+        return self.sim.done & (self.sim.time < self.sim.runtime)
 
     @property
     def done(self):
-        return self.timeout or self.out_of_bounds or self.is_task_finished()
+        return self.timeout | self.out_of_bounds | self.is_task_finished()
 
     def is_task_finished(self):
         return False
@@ -107,8 +126,9 @@ class Task():
         self.sim.pose[2] = np.random.normal(self.sim.pose[2], max(min(self.sim.pose[2] * 0.02, 10.0), 1.0))
 
         self.reset_vars()
-        state = np.concatenate([self.state] * self.action_repeat)
-        return state
+        frames = self.frame_buffer()
+        frames[:] = self.state
+        return frames.reshape(-1).copy()
 
     def reset_vars(self):
         pass
\ No newline at end of file
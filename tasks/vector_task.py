@@ -0,0 +1,97 @@
+import numpy as np
+from physics_sim import PhysicsSim, BatchedPhysicsSim, semi_explicit_step
+
+
+class VectorTask:
+    """Runs `num_envs` environments of a task on one BatchedPhysicsSim.
+
+    The task keeps its reward and termination code, which evaluates element-wise on the batched simulator.
+    States are returned as (num_envs, num_states) arrays, rewards and dones as (num_envs,) arrays. The task's
+    simulator must use the integration of BatchedPhysicsSim, with any control step dt.
+    """
+    def __init__(self, task, num_envs):
+        if not isinstance(task.sim, PhysicsSim):
+            raise TypeError("VectorTask needs a task simulated by PhysicsSim, got {}".format(type(task.sim).__name__))
+
+        self.task = task
+        self.num_envs = num_envs
+
+        sim = task.sim
+        if sim.integrator is not semi_explicit_step or sim.attitude != 'euler' or sim.substeps != 1:
+            raise ValueError("VectorTask only simulates one semi-explicit step with Euler angles per control step, "
+                             "not {} substeps of {} with {} attitude".format(
+                                 sim.substeps, getattr(sim.integrator, '__name__', sim.integrator), sim.attitude))
+        self.sim = task.sim = BatchedPhysicsSim(
+            num_envs, sim.init_pose, sim.init_velocities, sim.init_angle_velocities, sim.runtime, sim.use_jit,
+            sim.dt)
+
+        self.task_name = task.task_name
+        self.action_low = task.action_low
+        self.action_high = task.action_high
+
+        self.reset()
+
+    @property
+    def num_states(self):
+        return self.task.num_states
+
+    @property
+    def num_actions(self):
+        return self.task.num_actions
+
+    @property
+    def state(self):
+        """Current states of all environments, after the automatic reset of finished ones."""
+        return np.tile(self.sim.observation, (1, self.task.action_repeat))
+
+    def frame_buffer(self):
+        """Preallocated (num_envs, action_repeat, observation size) stack of the states of one step."""
+        shape = (self.num_envs, self.task.action_repeat, self.sim.observation.shape[1])
+        if getattr(self, '_frames', None) is None or self._frames.shape != shape:
+            self._frames = np.empty(shape)
+        return self._frames
+
+    def reset(self, mask=None):
+        """Reset all environments, or those selected by the boolean `mask`, and return the states of all."""
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        self.sim.reset(mask)
+
+        # Add some randomness to the z coordinate, same as Task.reset()
+        z = self.sim.pose[mask, 2]
+        self.sim.pose[mask, 2] = np.random.normal(z, np.clip(z * 0.02, 1.0, 10.0))
+
+        self.task.reset_vars()
+        return self.state
+
+    def step(self, actions):
+        """Step all environments with (num_envs, num_actions) actions.
+
+        Returns next states, rewards and dones. The next states of finished environments are their final
+        states, those environments are reset afterwards and `state` holds their new initial states.
+        """
+        actions = np.asarray(actions, dtype=float)
+        if self.task.simplified:
+            actions = np.repeat(actions[:, :1], 4, axis=1)
+
+        rewards = np.zeros(self.num_envs)
+        frames = self.frame_buffer()
+        active = ~self.sim.done
+        for _ in range(self.task.action_repeat):
+            self.sim.next_timestep(actions)
+            rewards += np.where(active, self.task.get_reward(), 0.0)
+            # Environments stop at the end of their episode, like Task.step()
+            if _ == 0:
+                frames[:, 0] = self.sim.observation
+            else:
+                frames[:, _] = frames[:, _ - 1]
+                np.copyto(frames[:, _], self.sim.observation, where=active[:, None])
+            active &= ~self.sim.done
+
+        next_states = frames.reshape(self.num_envs, -1).copy()
+        dones = np.broadcast_to(self.task.done, (self.num_envs,)).copy()
+
+        if dones.any():
+            self.reset(dones)
+
+        return next_states, rewards, dones